@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Microbenchmark for the conversion of package long descriptions into RST.
+
+Usage::
+
+  bench_pkgdescr.py <Packages[.gz]> [repetitions]
+
+All long descriptions of a real APT Packages file are converted with the
+plain converter, and with a cached converter (cold and warm cache).
+"""
+
+import gzip
+import sys
+import timeit
+
+from debian import deb822
+
+from bigmess.pkgdescr import long_descr_to_rst, DescriptionConverter
+
+
+def _load_descriptions(filename):
+    if filename.endswith('.gz'):
+        src = gzip.open(filename)
+    else:
+        src = open(filename, 'rb')
+    return [p['Description'].split('\n')[1:]
+            for p in deb822.Packages.iter_paragraphs(src)
+            if 'Description' in p]
+
+
+def main(filename, repeat=3):
+    descrs = _load_descriptions(filename)
+    print("%i descriptions (%i unique)"
+          % (len(descrs), len(set(['\n'.join(d) for d in descrs]))))
+
+    def plain():
+        for d in descrs:
+            long_descr_to_rst(d)
+
+    def cached_cold():
+        conv = DescriptionConverter()
+        for d in descrs:
+            conv(d)
+
+    warm = DescriptionConverter()
+    for d in descrs:
+        warm(d)
+
+    def cached_warm():
+        for d in descrs:
+            warm(d)
+
+    for label, func in (('plain', plain),
+                        ('cached (cold)', cached_cold),
+                        ('cached (warm)', cached_warm)):
+        t = min(timeit.repeat(func, number=1, repeat=repeat))
+        print("%-15s %8.3f s  %8.2f us/description"
+              % (label, t, t * 1e6 / max(1, len(descrs))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    main(sys.argv[1], *[int(a) for a in sys.argv[2:3]])
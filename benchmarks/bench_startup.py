@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Startup time benchmark for the ``bigmess`` entry point.
+
+Usage::
+
+  bench_startup.py [repetitions] [max_seconds]
+
+Reports the time to show the help of the main parser and of every command,
+and fails if
+
+- the command registry in bigmess.cmdline is out of sync with the cmd_*.py
+  modules,
+- heavy modules (APT bindings, network libraries, ...) are imported for a
+  lightweight command like ``querycfg``, or
+- ``max_seconds`` is given and the main help takes longer than that.
+"""
+
+import os
+import sys
+import glob
+import subprocess
+import timeit
+
+from bigmess.cmdline import COMMANDS
+
+BIGMESS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'bin', 'bigmess')
+
+HEAVY_MODULES = ('apt_pkg', 'debian.deb822', 'urllib.request', 'http.client',
+                 'jinja2', 'bigmess.mirrors')
+
+# prints all imported heavy modules after running the entry point
+_IMPORT_PROBE = """
+import sys, runpy
+sys.argv = %r
+try:
+    runpy.run_path(%r, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(' '.join([m for m in %r if m in sys.modules]))
+"""
+
+
+def _run(args):
+    subprocess.check_call([sys.executable, BIGMESS] + args,
+                          stdout=subprocess.DEVNULL)
+
+
+def _get_heavy_imports(args):
+    proc = subprocess.run(
+        [sys.executable, '-c',
+         _IMPORT_PROBE % (['bigmess'] + args, BIGMESS, HEAVY_MODULES)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+        universal_newlines=True)
+    return proc.stderr.split()
+
+
+def _check_registry():
+    cmd_dir = os.path.dirname(sys.modules['bigmess.cmdline'].__file__)
+    modules = set([os.path.basename(m)[4:-3]
+                   for m in glob.glob(os.path.join(cmd_dir, 'cmd_*.py'))])
+    registered = set([c[0] for c in COMMANDS])
+    errors = []
+    if modules - registered:
+        errors.append("commands missing in registry: %s"
+                      % ', '.join(sorted(modules - registered)))
+    if registered - modules:
+        errors.append("registered commands without module: %s"
+                      % ', '.join(sorted(registered - modules)))
+    return errors
+
+
+def main(repeat=5, max_seconds=None):
+    errors = _check_registry()
+    timings = []
+    for label, args in [('(main)', [])] \
+            + [(c[0], [c[0]]) for c in COMMANDS]:
+        t = min(timeit.repeat(lambda: _run(args + ['--help-np']),
+                              number=1, repeat=repeat))
+        timings.append((label, t))
+        print("%-20s %8.3f s" % (label, t))
+    heavy = _get_heavy_imports(['querycfg'])
+    if len(heavy):
+        errors.append("heavy modules imported for querycfg: %s"
+                      % ', '.join(heavy))
+    if not max_seconds is None and timings[0][1] > max_seconds:
+        errors.append("startup takes %.3f s (limit: %.3f s)"
+                      % (timings[0][1], max_seconds))
+    for e in errors:
+        print("FAILED: %s" % e)
+    return len(errors) == 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3 or '-h' in sys.argv or '--help' in sys.argv:
+        print(__doc__)
+        sys.exit(1)
+    args = sys.argv[1:]
+    ok = main(*([int(a) for a in args[:1]] + [float(a) for a in args[1:2]]))
+    sys.exit(0 if ok else 1)
@@ -6,20 +6,55 @@
 #   copyright and license terms.
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
-""" """
+"""Command line interface.
+
+Each command is implemented in a ``cmd_<name>`` module of this package that
+provides ``setup_parser(parser)`` and ``run(args)``. These modules are not
+imported here, as many of them pull in heavy dependencies (APT bindings,
+network libraries, ...). Instead, ``COMMANDS`` lists the name and summary of
+each command, and a command's module is only imported once it is selected.
+"""
 
 __docformat__ = 'restructuredtext'
 
-from . import cmd_cachefiles
-from . import cmd_bootstrap_buildenv
-from . import cmd_build_pkg
-from . import cmd_build_pkg_condor
-from . import cmd_querycfg
-from . import cmd_mkpkgs
-from . import cmd_mkaptcfgs
-from . import cmd_mkrepocfg
-from . import cmd_mkpkgtocs
-from . import cmd_run_buildenv
-from . import cmd_updatedb
-from . import cmd_update_buildenv
-from . import cmd_mkmirrorsstat
+import importlib
+
+# (name, summary) of all commands -- keep in sync with the cmd_*.py modules
+COMMANDS = (
+    ('bootstrap_buildenv', 'Bootstrap a build environment'),
+    ('build_pkg', 'Build a package in one or more environments.'),
+    ('build_pkg_condor',
+     'Just like build_pkg, but submits builds to a Condor pool.'),
+    ('cachefiles', 'Cache package information.'),
+    ('mkaptcfgs', 'Generate APT sources lists for all configured mirrors.'),
+    ('mkmirrorsstat', 'Generate mirrors status webpage and update the time '
+                      'stamp in the deployed location.'),
+    ('mkpkgs', 'Generate package pages in reStructured Text or HTML format.'),
+    ('mkpkgtocs', 'Generate table of contents pages for packages sort by '
+                  'various criteria.'),
+    ('mkrepocfg', 'Generate repository configuration helpers from a '
+                  'template.'),
+    ('mksearchindex', 'Generate a search index of all binary packages for '
+                      'the package portal.'),
+    ('querycfg', 'Query the configuration.'),
+    ('refresh', 'Refresh the package portal in a single process.'),
+    ('run_buildenv', 'Run a build environment'),
+    ('serve', 'Answer queries on the package DB via HTTP.'),
+    ('update_buildenv', 'Update a build environment'),
+    ('updatedb', 'Update package info DB.'),
+)
+
+
+def load_command(name):
+    """Import the module implementing a command.
+
+    Parameters
+    ----------
+    name : str
+      Command name, as listed in ``COMMANDS``
+
+    Returns
+    -------
+    module
+    """
+    return importlib.import_module('%s.cmd_%s' % (__name__, name))
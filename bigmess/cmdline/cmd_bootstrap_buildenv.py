@@ -32,13 +32,12 @@ __docformat__ = 'restructuredtext'
 
 import argparse
 import sys
-import xdg
 from copy import deepcopy
 import subprocess
 import os
 from os.path import join as opj
 from bigmess import cfg
-from .helpers import parser_add_common_args, get_dir_cfg, get_build_option
+from .helpers import parser_add_common_args, get_build_settings
 import logging
 lgr = logging.getLogger(__name__)
 
@@ -52,54 +51,42 @@ def setup_parser(parser):
             help="""list of archive components to enable in the build
             environment. For example: main contrib non-free""")
 
-def _proc_env(family, codename, args):
-    aptcache = get_dir_cfg('aptcache', args.aptcache, family,
-                           ensure_exists=False)
-    components = get_build_option('components', args.components, family,
-                                  default='main').split()
+def _proc_env(settings, args):
+    codename = settings.codename
+    components = settings.components
     lgr.debug("enabling components %s" % components)
 
     cmd_opts_prefix = [
         '--create',
         '--distribution', codename,
         '--debootstrap', 'debootstrap', # make me an option
-        '--aptcache', aptcache,
+        '--aptcache', settings.aptcache,
         '--components', ' '.join(components), 
     ]
 
-    bootstrap_keyring = get_dir_cfg('bootstrap keyring', None, family,
-                           ensure_exists=False)
-    if not bootstrap_keyring is None:
-        cmd_opts_prefix += ['--debootstrapopts', '--keyring=%s' % bootstrap_keyring]
-    keyring = get_dir_cfg('keyring', None, family, ensure_exists=False)
-    if not keyring is None:
-        cmd_opts_prefix += ['--keyring', keyring]
-    mirror = get_build_option('mirror', None, family)
-    if not mirror is None:
-        cmd_opts_prefix += ['--mirror', mirror]
-    othermirror = get_build_option('othermirror', None, family)
-    if not othermirror is None:
-        cmd_opts_prefix += ['--othermirror',
-                            othermirror % {'release': codename}]
-    chroot_basedir = get_dir_cfg('chroot basedir', args.chroot_basedir, family,
-                                 ensure_exists=False,
-                                 default=opj(xdg.BaseDirectory.xdg_data_home,
-                                             'bigmess', 'chroots'))
-
-    builder = get_build_option('builder', args.builder, family, default='pbuilder')
+    if not settings.bootstrap_keyring is None:
+        cmd_opts_prefix += ['--debootstrapopts',
+                            '--keyring=%s' % settings.bootstrap_keyring]
+    if not settings.keyring is None:
+        cmd_opts_prefix += ['--keyring', settings.keyring]
+    if not settings.mirror is None:
+        cmd_opts_prefix += ['--mirror', settings.mirror]
+    if not settings.othermirror is None:
+        cmd_opts_prefix += ['--othermirror', settings.othermirror]
+    chroot_basedir = settings.chroot_basedir
+
+    builder = settings.builder
     lgr.debug("using '%s' for building" % builder)
 
-    archs = get_build_option('architectures', args.arch, family, default=None)
+    archs = settings.architectures
     if archs is None:
         raise ValueError("no architectures specified, use --arch or add to configuration file")
-    if not isinstance(archs, list):
-        archs = archs.split()
 
     for arch in archs:
         cmd_opts = deepcopy(cmd_opts_prefix)
         lgr.debug("started bootstrapping architecture '%s'" % arch)
         chroot_targetdir = opj(chroot_basedir,
-                               '%s-%s-%s' % (family, codename, arch))
+                               '%s-%s-%s' % (settings.family, codename, arch))
         if os.path.exists(chroot_targetdir):
             lgr.warning("'%s' exists -- ignoring architecture '%s'" % (chroot_targetdir, arch))
             continue
@@ -128,5 +115,5 @@ def run(args):
     for env in args.env:
         lgr.debug("started bootstrapping environment '%s'" % env)
         family, codename = env
-        _proc_env(family, codename, args)
+        _proc_env(get_build_settings(family, codename, args), args)
         lgr.debug("finished bootstrapping environment '%s'" % env)
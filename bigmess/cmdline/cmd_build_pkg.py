@@ -23,7 +23,6 @@ __docformat__ = 'restructuredtext'
 
 import argparse
 import sys
-import xdg
 import time
 from copy import deepcopy
 from debian import deb822
@@ -31,8 +30,9 @@ import subprocess
 import os
 from os.path import join as opj
 from bigmess import cfg
-from .helpers import parser_add_common_args, get_build_option, arg2bool, \
-        get_dir_cfg
+from ..utils import metrics
+from .helpers import parser_add_common_args, arg2bool, get_build_settings, \
+        ensure_dir
 import logging
 lgr = logging.getLogger(__name__)
 
@@ -79,34 +79,26 @@ def setup_parser(parser):
     parser.add_argument('dsc')
 
 
-def _backport_dsc(dsc, codename, family, args, dryrun=False):
+def _backport_dsc(dsc, settings, dryrun=False):
     dsc_dict = deb822.Dsc(open(dsc))
     # assemble backport-dsc call
-    bp_args = ['--target-distribution', codename]
-    bp_mod_control = get_build_option('backport modify control',
-                                      args.bp_mod_control,
-                                      family)
-    modcontrol_blacklist = get_build_option('backport modify control blacklist',
-                                            family=family,
-                                            default='').split()
+    bp_args = ['--target-distribution', settings.codename]
+    bp_mod_control = settings.backport_modify_control
     # if blacklisted for this source package: reset
-    if dsc_dict['Source'] in modcontrol_blacklist:
+    if dsc_dict['Source'] in settings.backport_modify_control_blacklist:
         lgr.debug("source package '%s' is blacklisted for control file modification"
                   % dsc_dict['Source'])
         bp_mod_control = None
     if not bp_mod_control is None:
         bp_args += ['--mod-control', bp_mod_control]
-    bp_maintainer = get_build_option('backport maintainer',
-                                     args.bp_maintainer,
-                                     family)
+    bp_maintainer = settings.backport_maintainer
     if not bp_maintainer is None:
         bp_args += [
             '--maint-name', bp_maintainer.split('<')[0].strip(),
             '--maint-email', bp_maintainer.split('<')[1].strip()[:-1],
         ]
-    if cfg.has_option('release backport ids', codename):
-        bp_args += ['--version-suffix',
-                    cfg.get('release backport ids', codename)]
+    if not settings.backport_version_suffix is None:
+        bp_args += ['--version-suffix', settings.backport_version_suffix]
     lgr.debug('attempting to backport source package')
     bp_success = False
     bp_cmd = ['backport-dsc'] + bp_args + [dsc]
@@ -130,16 +122,10 @@ def _backport_dsc(dsc, codename, family, args, dryrun=False):
         raise RuntimeError("failure to parse output of 'backport-dsc'")
     return backported_dsc
 
-def _get_chroot_base(family, codename, arch, args):
-    chroot_basedir = get_build_option('chroot basedir',
-                                      args.chroot_basedir,
-                                      family,
-                                      default=opj(xdg.BaseDirectory.xdg_data_home,
-                                                  'bigmess', 'chroots'))
-    chroot_basedir = os.path.expanduser(os.path.expandvars(chroot_basedir))
-    lgr.debug("using chroot base directory at '%s'" % chroot_basedir)
-    chroot_target = opj(chroot_basedir,
-                        '%s-%s-%s' % (family, codename, arch))
+def _get_chroot_base(settings, arch):
+    lgr.debug("using chroot base directory at '%s'" % settings.chroot_basedir)
+    chroot_target = opj(settings.chroot_basedir,
+                        '%s-%s-%s' % (settings.family, settings.codename, arch))
     return chroot_target
 
 
@@ -148,55 +134,43 @@ def _get_arch_from_dsc(fname):
         if line.startswith('Architecture:'):
             return line.split(':')[1].strip()
 
-def _proc_env(family, codename, args, source_include):
-    builder = get_build_option('builder', args.builder, family, default='pbuilder')
+def _proc_env(settings, args, source_include):
+    builder = settings.builder
     lgr.debug("using '%s' for building" % builder)
 
-    aptcache = get_dir_cfg('aptcache', args.aptcache, family,
-                           ensure_exists=False)
-
     cmd_opts_prefix = [
         '--build',
-        '--aptcache', aptcache,
+        '--aptcache', settings.aptcache,
     ]
 
-    build_basedir = get_dir_cfg('build basedir', args.build_basedir, family,
-                                ensure_exists=True)
+    build_basedir = settings.build_basedir
+    ensure_dir(build_basedir)
     if not build_basedir is None:
         cmd_opts_prefix += ['--buildplace', build_basedir]
 
-    result_dir = get_dir_cfg('result directory', args.result_dir, family,
-                             ensure_exists=True)
+    result_dir = settings.result_dir
     if result_dir is None:
         result_dir = os.path.abspath(os.curdir)
     cmd_opts_prefix += ['--buildresult', result_dir]
-    if not os.path.exists(result_dir):
-        os.makedirs(result_dir)
+    ensure_dir(result_dir)
 
     # backport
     if args.backport:
-        backported_dsc = _backport_dsc(args.dsc, codename, family, args,
-                                       dryrun=args.dry_run)
-
-    archs = get_build_option('architectures', args.arch, family)
-    if not archs is None:
-        if not isinstance(archs, list):
-            archs = archs.split()
+        backported_dsc = _backport_dsc(args.dsc, settings, dryrun=args.dry_run)
 
+    archs = settings.architectures
     if _get_arch_from_dsc(args.dsc) == 'all':
         # where to build arch:all packages
-        archs = [get_build_option('archall architecture', args.arch_all_arch, family,
-                                  default='amd64')]
+        archs = [settings.archall_architecture]
     if archs is None:
         raise ValueError("no architectures specified, use --arch or add to configuration file")
 
+    debbuild_options = settings.debbuild_options
     had_failures = False
     first_arch = True
     for arch in archs:
         # start fresh (in-place mods below)
         cmd_opts = deepcopy(cmd_opts_prefix)
-        # source include?
-        debbuild_options = get_build_option('debbuild options', args.debbuild_options, family)
         # what kind of build are we aiming for
         if first_arch:
             # first round
@@ -212,14 +186,15 @@ def _proc_env(family, codename, args, source_include):
             # except for the first one all others are binary only
             buildtype_opt = ' -B'
         if not debbuild_options is None:
-            debbuild_options = '%s %s' % (buildtype_opt, debbuild_options)
+            arch_debbuild_options = '%s %s' % (buildtype_opt, debbuild_options)
         else:
-            debbuild_options = buildtype_opt
-        cmd_opts += ['--debbuildopts', debbuild_options]
-        lgr.debug("using additional debbuild options '%s'" % debbuild_options)
+            arch_debbuild_options = buildtype_opt
+        cmd_opts += ['--debbuildopts', arch_debbuild_options]
+        lgr.debug("using additional debbuild options '%s'"
+                  % arch_debbuild_options)
 
         lgr.debug("started building for architecture '%s'" % arch)
-        chroot_target = _get_chroot_base(family, codename, arch, args)
+        chroot_target = _get_chroot_base(settings, arch)
         if builder == 'pbuilder':
             cmd_opts += ['--basetgz', '%s.tar.gz' % chroot_target]
         elif builder == 'cowbuilder':
@@ -241,14 +216,17 @@ def _proc_env(family, codename, args, source_include):
                       '%(Source)s_%(Version)s_%(arch)s_%(buildtime)s.build' % dsc),
                   'w') as logfile:
             lgr.info("build log at '%s'" % logfile.name)
-            ret = subprocess.call(sp_args,
-                                  stderr=subprocess.STDOUT,
-                                  stdout=logfile) 
-            summaryline = '%s %s ' % (family, codename)
+            with metrics.timer('builds'):
+                ret = subprocess.call(sp_args,
+                                      stderr=subprocess.STDOUT,
+                                      stdout=logfile)
+            metrics.inc('builds_run')
+            summaryline = '%s %s ' % (settings.family, settings.codename)
             summaryline += '%(arch)s %(Source)s %(Version)s %(buildtime)s ' % dsc
             if ret:
                 summaryline += 'FAILED\n'
                 had_failures = True
+                metrics.inc('builds_failed')
                 lgr.warning("building failed (cmd: '%s'; exit code: %s)"
                                    % (sp_args, ret))
             else:
@@ -265,14 +243,14 @@ def run(args):
     source_include = args.source_include
     for family, codename in args.env:
         lgr.debug("started building in environment '%s-%s'" % (family, codename))
+        settings = get_build_settings(family, codename, args)
         if args.backport:
             # start with default for each backport run, i.e. source package version
             source_include = args.source_include
         if source_include is None:
             # any configure source include strategy?
-            source_include = arg2bool(get_build_option('source include', None,
-                                                       family, default=None))
-        if _proc_env(family, codename, args, source_include):
+            source_include = arg2bool(settings.source_include)
+        if _proc_env(settings, args, source_include):
             had_failures = True
         # don't include more than once per source package version - will cause
         # problem as parts of the source packages get regenerated and original
@@ -47,7 +47,8 @@ import os
 import sys
 from os.path import join as opj
 from bigmess import cfg
-from .helpers import parser_add_common_args, get_build_option, get_dir_cfg, \
+from ..utils import metrics
+from .helpers import parser_add_common_args, get_build_settings, ensure_dir, \
         arg2bool
 from .cmd_build_pkg import _backport_dsc, _get_chroot_base
 import logging
@@ -157,27 +158,25 @@ executable = %(executable)s
                                         args.condor_request_cpus)
     source_include = args.source_include
     for family, codename in args.env:
+        settings = get_build_settings(family, codename, args)
         # change into the 'result-dir' to have Condor transfer all output here
-        result_dir = get_dir_cfg('result directory', args.result_dir, family,
-                                 ensure_exists=True)
-        build_basedir = get_dir_cfg('build basedir', args.build_basedir, family,
-                                    ensure_exists=True)
+        result_dir = settings.result_dir
+        ensure_dir(result_dir)
+        build_basedir = settings.build_basedir
+        ensure_dir(build_basedir)
         if not result_dir is None:
             os.chdir(result_dir)
         # do any backports locally
         if args.backport:
             lgr.info("backporting to %s-%s" % (family, codename))
-            dist_dsc_fname = _backport_dsc(dsc_fname, codename, family, args)
+            dist_dsc_fname = _backport_dsc(dsc_fname, settings)
             # start with default for each backport run, i.e. source package version
             source_include = args.source_include
         else:
             dist_dsc_fname = dsc_fname
         if source_include is None:
             # any configure source include strategy?
-            source_include = get_build_option('source include', source_include,
-                                              family, default=None)
-            if not source_include is None:
-                source_include = arg2bool(source_include)
+            source_include = arg2bool(settings.source_include)
         dist_dsc = deb822.Dsc(open(dist_dsc_fname))
         dist_dsc_dir = os.path.dirname(dist_dsc_fname)
         # some verbosity for debugging
@@ -188,16 +187,14 @@ executable = %(executable)s
         if not args.common_config_file is None:
             transfer_files += args.common_config_file
         # logfile destination?
-        logdir = get_dir_cfg('condor logdir', args.condor_logdir, family,
-                             default=os.curdir, ensure_exists=True)
-        archs = get_build_option('architectures', args.arch, family)
+        logdir = settings.condor_logdir
+        ensure_dir(logdir)
+        archs = settings.architectures
         # TODO limit to default arch for arch:all packages
-        if isinstance(archs, str):
-            archs = archs.split()
         first_arch = True
         for arch in archs:
             # basetgz
-            basetgz = '%s.tar.gz' % _get_chroot_base(family, codename, arch, args)
+            basetgz = '%s.tar.gz' % _get_chroot_base(settings, arch)
             if first_arch:
                 if source_include == True:
                     # force inclusion
@@ -250,3 +247,4 @@ queue
         condor_submit.communicate(input=submit)
         if condor_submit.wait():
             raise RuntimeError("could not submit build; SPEC follows\n---\n%s---\n)" % submit)
+        metrics.inc('build_submissions')
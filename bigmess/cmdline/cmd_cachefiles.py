@@ -26,6 +26,8 @@ from os.path import join as opj
 
 from bigmess import cfg
 from .helpers import parser_add_common_args
+from ..utils import metrics
+from ..profiling import phase
 
 lgr = logging.getLogger(__name__)
 parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -46,20 +48,26 @@ def _download_file(url, dst, force_update=False, ignore_missing=False):
     if os.path.isfile(dst) and not force_update:
         lgr.debug("skip '%s'->'%s' (file exists)" % (url, dst))
         return True
-    try:
-        urip = urllib.request.urlopen(url)
-        fp = open(dst, 'wb')
-        lgr.debug("download '%s'->'%s'" % (url, dst))
-        fp.write(urip.read())
-        fp.close()
-        return True
-    except urllib.error.HTTPError:
-        if not ignore_missing:
-            lgr.warning("cannot find '%s'" % url)
-        return False
-    except urllib.error.URLError:
-        lgr.warning("cannot connect to '%s'" % url)
-        return False
+    with phase('download'):
+        try:
+            urip = urllib.request.urlopen(url)
+            fp = open(dst, 'wb')
+            lgr.debug("download '%s'->'%s'" % (url, dst))
+            content = urip.read()
+            fp.write(content)
+            fp.close()
+            metrics.inc('files_downloaded')
+            metrics.inc('bytes_downloaded', len(content))
+            return True
+        except urllib.error.HTTPError:
+            if not ignore_missing:
+                lgr.warning("cannot find '%s'" % url)
+                metrics.inc('download_failures')
+            return False
+        except urllib.error.URLError:
+            lgr.warning("cannot connect to '%s'" % url)
+            metrics.inc('download_failures')
+            return False
 
 
 def _url2filename(cache, url):
@@ -91,8 +99,17 @@ def _find_release_origin_archive(cfg, release):
         return None
     return origins[0]
 
-def run(args):
-    lgr.debug("using file cache at '%s'" % args.filecache)
+def cache_files(filecache, force_update=False):
+    """Download all files required to update the package DB into a cache.
+
+    Parameters
+    ----------
+    filecache : str
+      Path of the file cache
+    force_update : bool
+      If True, files already present in the cache are downloaded again.
+    """
+    lgr.debug("using file cache at '%s'" % filecache)
     # get all metadata files from the repo
     meta_baseurl = cfg.get('metadata', 'source extracts baseurl',
                            default=None)
@@ -106,13 +123,13 @@ def run(args):
     # for preventing unnecessary queries
     lookupcache = {}
     # ensure the cache is there
-    if not os.path.exists(args.filecache):
-        os.makedirs(args.filecache)
+    if not os.path.exists(filecache):
+        os.makedirs(filecache)
     for release in releases:
         rurl = cfg.get('release files', release)
         # first get 'Release' files
-        dst_path = _url2filename(args.filecache, rurl)
-        if not _download_file(rurl, dst_path, args.force_update):
+        dst_path = _url2filename(filecache, rurl)
+        if not _download_file(rurl, dst_path, force_update):
             continue
         baseurl = '/'.join(rurl.split('/')[:-1])
         comps, archs = _proc_release_file(dst_path, baseurl)
@@ -122,13 +139,13 @@ def run(args):
                 # also get 'Packages.gz' for each component and architecture
                 purl = '/'.join((baseurl, comp,
                                  'binary-%s' % arch, 'Packages.gz'))
-                dst_path = _url2filename(args.filecache, purl)
-                if not _download_file(purl, dst_path, args.force_update):
+                dst_path = _url2filename(filecache, purl)
+                if not _download_file(purl, dst_path, force_update):
                     continue
             # also get 'Sources.gz' for each component
             surl = '/'.join((baseurl, comp, 'source', 'Sources.gz'))
-            dst_path = _url2filename(args.filecache, surl)
-            if not _download_file(surl, dst_path, args.force_update):
+            dst_path = _url2filename(filecache, surl)
+            if not _download_file(surl, dst_path, force_update):
                 continue
             # TODO go through the source file and try getting 'debian/upstream'
             # from the referenced repo
@@ -148,10 +165,10 @@ def run(args):
                 lgr.debug("query metadata for source package '%s'" % src_name)
                 for mfn in meta_filenames:
                     mfurl = '/'.join((meta_baseurl, src_name, mfn))
-                    dst_path = _url2filename(args.filecache, mfurl)
+                    dst_path = _url2filename(filecache, mfurl)
                     if dst_path in lookupcache:
                         continue
-                    _download_file(mfurl, dst_path, args.force_update,
+                    _download_file(mfurl, dst_path, force_update,
                                    ignore_missing=True)
                     lookupcache[dst_path] = None
 
@@ -169,8 +186,8 @@ def run(args):
         obaseurl = '%s/%s' % (oarchive, '/'.join(rurl.split('/')[-3:-1]))
         orurl = '%s/Release' % obaseurl
         # first get 'Release' files
-        dst_path = _url2filename(args.filecache, orurl)
-        if not _download_file(orurl, dst_path, args.force_update):
+        dst_path = _url2filename(filecache, orurl)
+        if not _download_file(orurl, dst_path, force_update):
             continue
 
         comps, _ = _proc_release_file(dst_path, obaseurl)
@@ -178,8 +195,8 @@ def run(args):
             # Fetch information on source packages -- we are not interested
             # to provide a thorough coverage -- just the version
             osurl = '/'.join((obaseurl, comp, 'source', 'Sources.gz'))
-            dst_path = _url2filename(args.filecache, osurl)
-            if not _download_file(osurl, dst_path, args.force_update):
+            dst_path = _url2filename(filecache, osurl)
+            if not _download_file(osurl, dst_path, force_update):
                 continue
 
     #
@@ -188,6 +205,10 @@ def run(args):
     tasks = cfg.options('task files')
     for task in tasks:
         rurl = cfg.get('task files', task)
-        dst_path = opj(args.filecache, 'task_%s' % task)
-        if not _download_file(rurl, dst_path, args.force_update):
+        dst_path = opj(filecache, 'task_%s' % task)
+        if not _download_file(rurl, dst_path, force_update):
             continue
+
+
+def run(args):
+    cache_files(args.filecache, args.force_update)
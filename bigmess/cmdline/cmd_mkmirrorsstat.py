@@ -8,6 +8,39 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Generate mirrors status webpage and update the time stamp in the deployed location.
 
+All mirrors are probed concurrently. Each request to a mirror times out after
+--timeout seconds, and probing ends after --deadline seconds in total. Mirrors
+that do not respond in time are reported as unreachable. Defaults for both
+can be configured via the 'timeout' and 'deadline' settings in the
+'mirrors monitor' section of the configuration.
+
+The outcome of every probe is appended to a history file (by default
+mirrors_history.tsv in the cache directory). If a mirror cannot be reached,
+the page reports the age of the last timestamp that was ever obtained from it.
+The page also lists the uptime, the fraction of probes that found a mirror
+fresh, and the trend of the freshness over the last --stats-days days. With
+--from-history the page is generated from the history alone, without probing
+any mirror.
+
+With --benchmark a reference file (--benchmark-file) is downloaded from each
+mirror, recording the time to connect, the time to the first byte, and the
+throughput. The page then includes a table of mirrors ranked by download
+time, and the measurements are also stored as JSON (--speed-json) for use by
+'bigmess mkrepocfg'. As mirrors are measured concurrently, they share the
+local bandwidth -- use --jobs 1 for throughput figures of individual mirrors.
+
+With --check-consistency the Release file of each configured release is
+fetched from the primary archive and from every mirror. The page then reports
+for each mirror and release whether the mirror lists the same index files with
+the same checksums, has an older Release file, or is inconsistent.
+
+With --daemon the command keeps running and probes the mirrors every
+--interval seconds. A mirror that fails is probed less often: the interval is
+doubled with each consecutive failure, up to --max-backoff seconds.
+Connections to mirrors are kept open between probes. The page is only
+re-generated when the status of a mirror changes. In this mode only the stamp
+files are probed, i.e. --benchmark and --check-consistency are not
+supported.
 """
 
 __docformat__ = 'restructuredtext'
@@ -17,21 +50,86 @@ __docformat__ = 'restructuredtext'
 
 import argparse
 import os
+import json
+import time
 import logging
 
 from os.path import join as opj
 
 from bigmess import cfg
+from .helpers import parser_add_common_opt
+from ..utils import get_template, get_cache_dir, write_if_changed, metrics
+from ..mirrors import get_mirror_urls, fetch_url, probe_mirrors, \
+        ConnectionPool, get_releases, \
+        measure_download, rank_by_speed, get_release_paths, parse_release, \
+        compare_releases, MirrorHistory, CONSISTENCY_OK, CONSISTENCY_OUTDATED, \
+        CONSISTENCY_MISMATCH, DEFAULT_TIMEOUT, DEFAULT_DEADLINE, STATUS_OK, \
+        STATUS_OLD, STATUS_BROKEN, STATUS_FAILED, STATUS_UNREACHABLE, \
+        REACHABLE_STATUSES
 
 lgr = logging.getLogger(__name__)
 parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
 
+# how probe outcomes are shown on the status page
+STATUS_LABELS = {STATUS_OK: "OK",
+                 STATUS_OLD: "**OLD**",
+                 STATUS_BROKEN: "**BRK**",
+                 STATUS_FAILED: "**N/A**",
+                 STATUS_UNREACHABLE: "**UNREACHABLE**"}
+CONSISTENCY_LABELS = {CONSISTENCY_OK: "OK",
+                      CONSISTENCY_OUTDATED: "**OUTDATED**",
+                      CONSISTENCY_MISMATCH: "**INCONSISTENT**",
+                      STATUS_FAILED: "**N/A**",
+                      STATUS_UNREACHABLE: "**UNREACHABLE**"}
+
 
 def setup_parser(parser):
     parser.add_argument('-t', '--timestamp-dir', default=os.curdir,
                         help="""deployed directory where timestamp file to be kept""")
     parser.add_argument('-d', '--dest-dir', default=os.curdir,
                         help="""target directory for storing the generated page""")
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help="""time to wait for any response of a mirror.
+                        Default: %i seconds""" % DEFAULT_TIMEOUT)
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help="""time for probing all mirrors. Default: %i
+                        seconds""" % DEFAULT_DEADLINE)
+    parser_add_common_opt(parser, 'jobs', default=None,
+                          help="""maximum number of mirrors to probe at the
+                          same time. Default: all""")
+    parser.add_argument('--history', metavar='PATH',
+                        default=opj(get_cache_dir(), 'mirrors_history.tsv'),
+                        help="""file to record the outcome of all probes in.
+                        Default: mirrors_history.tsv in the cache directory""")
+    parser.add_argument('--from-history', action='store_true',
+                        help="""generate the page from the most recent
+                        recorded probes, without probing any mirror""")
+    parser.add_argument('--stats-days', type=float, metavar='DAYS',
+                        help="""period to compute uptime and trend statistics
+                        for. Default: 7 days""")
+    parser.add_argument('--keep-days', type=float, metavar='DAYS',
+                        help="""drop recorded probes that are older than this.
+                        Default: 90 days. 0 keeps all records""")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="""also measure how fast the mirrors are""")
+    parser.add_argument('--benchmark-file', metavar='PATH',
+                        help="""path of the file to download from each mirror,
+                        relative to its base URL. Default: the Release file of
+                        the first configured release""")
+    parser.add_argument('--speed-json', metavar='PATH',
+                        help="""file to store the measurements in. Default:
+                        mirrors_speed.json in the destination directory""")
+    parser.add_argument('--check-consistency', action='store_true',
+                        help="""also compare the Release files of all releases
+                        on each mirror with those of the primary archive""")
+    parser.add_argument('--daemon', action='store_true',
+                        help="""keep probing the mirrors periodically""")
+    parser.add_argument('--interval', type=float, metavar='SECONDS',
+                        help="""time between probes of a mirror in daemon
+                        mode. Default: 600 seconds""")
+    parser.add_argument('--max-backoff', type=float, metavar='SECONDS',
+                        help="""maximum time between probes of a failing
+                        mirror in daemon mode. Default: 21600 seconds""")
 
 
 def _literal_seconds(t):
@@ -61,52 +159,318 @@ def test_literal_seconds():
     assert(_literal_seconds(3600*24*4) == '4 days 0 seconds')   # awkward -- TODO
 
 
-def run(args):
-    import codecs, time, urllib.request, urllib.error, urllib.parse
-    from jinja2 import Environment, PackageLoader, FileSystemLoader
-    jinja_env = Environment(loader=PackageLoader('bigmess'))
-    template = jinja_env.get_template('mirrors_status.rst')
+def _assess_stamp(mirror, stamp, now, warn_threshold):
+    try:
+        stamp = int(stamp)
+    except (TypeError, ValueError):
+        # int conversion has failed -- there is smth else in that file
+        lgr.error("Cannot assess the age. Retrieved stamp was %r" % stamp)
+        return STATUS_BROKEN, None
+    age = now - stamp
+    if age > warn_threshold:
+        age_str = _literal_seconds(age)
+        lgr.warning("Mirror %(mirror)s is %(age_str)s old", locals())
+        return STATUS_OLD, stamp
+    return STATUS_OK, stamp
 
-    stampfile = cfg.get('mirrors monitor', 'stampfile', 'TIMESTAMP')
-    warn_threshold = cfg.getfloat('mirrors monitor', 'warn-threshold') * 3600
 
-    lgr.debug("using stampfile %(stampfile)s", locals())
+def _get_benchmark_file():
+    path = cfg.get('mirrors monitor', 'benchmark file')
+    if not path is None:
+        return path
+    releases = get_releases()
+    if len(releases):
+        return 'dists/%s/Release' % releases[0]
+    return cfg.get('mirrors monitor', 'stampfile', 'TIMESTAMP')
 
-    mirrors_info = {}
-    for mirror in cfg.options('mirrors'):
 
-        mirror_url = cfg.get('mirrors', mirror)
+def _benchmark_mirrors(mirror_urls, reference, timeout, jobs, deadline):
+    measurements = probe_mirrors(
+        dict([(m, '%s/%s' % (url, reference))
+              for m, url in mirror_urls.items()]),
+        lambda url: measure_download(url, timeout),
+        jobs=jobs,
+        deadline=deadline)
+    ranked = rank_by_speed(measurements)
+    speed = []
+    for mirror in ranked + sorted(set(measurements).difference(ranked)):
+        res = measurements[mirror]
+        entry = dict(mirror=mirror,
+                     url=mirror_urls[mirror],
+                     name=cfg.get('mirror names', mirror),
+                     rank=None, connect=None, ttfb=None, total=None,
+                     size=None, throughput=None, error=None)
+        if res['result'] is None:
+            if res['unreachable']:
+                entry['error'] = 'timeout'
+            else:
+                entry['error'] = str(res['error'])
+            lgr.error("Cannot measure speed of mirror %s: %s"
+                      % (mirror, entry['error']))
+        else:
+            entry.update(res['result'])
+            entry['rank'] = ranked.index(mirror) + 1
+        speed.append(entry)
+    return speed
+
+
+def _check_consistency(mirror_urls, timeout, jobs, deadline):
+    release_paths = get_release_paths()
+    # Release files of the primary archive are keyed by a None mirror
+    urls = dict([((None, r), cfg.get('release files', r))
+                 for r in release_paths])
+    for mirror, mirror_url in mirror_urls.items():
+        for release, path in release_paths.items():
+            urls[(mirror, release)] = '%s/%s' % (mirror_url, path)
+    fetched = probe_mirrors(urls, lambda url: fetch_url(url, timeout),
+                            jobs=jobs, deadline=deadline)
+
+    def parse(key):
+        res = fetched[key]
+        if res['unreachable']:
+            return STATUS_UNREACHABLE, None
+        if res['result'] is None:
+            lgr.error("Cannot fetch '%s': %s" % (urls[key], res['error']))
+            return STATUS_FAILED, None
+        try:
+            return None, parse_release(res['result'])
+        except (UnicodeDecodeError, KeyError, ValueError) as e:
+            lgr.error("Cannot parse '%s': %s" % (urls[key], e))
+            return STATUS_FAILED, None
+
+    consistency = dict([(m, {}) for m in mirror_urls])
+    for release in release_paths:
+        failure, primary = parse((None, release))
+        for mirror in mirror_urls:
+            if not failure is None:
+                # nothing to compare with
+                consistency[mirror][release] = (STATUS_FAILED, [])
+                continue
+            mfailure, mrelease = parse((mirror, release))
+            if not mfailure is None:
+                consistency[mirror][release] = (mfailure, [])
+                continue
+            status, differ = compare_releases(primary, mrelease)
+            if status != CONSISTENCY_OK:
+                lgr.warning("Mirror %s is %s for %s (%i differing index files)"
+                            % (mirror, status, release, len(differ)))
+            consistency[mirror][release] = (status, differ)
+    return consistency
+
+
+def _probe_stamps(mirror_urls, stampfile, fetch, jobs, deadline,
+                  warn_threshold):
+    probes = probe_mirrors(
+        dict([(m, '%s/%s' % (url, stampfile))
+              for m, url in mirror_urls.items()]),
+        fetch,
+        jobs=jobs,
+        deadline=deadline)
+    now = time.time()
+    outcomes = {}
+    records = []
+    for mirror, mirror_url in mirror_urls.items():
+        probe = probes[mirror]
+        if probe['unreachable']:
+            lgr.error("Mirror %s did not respond in time" % mirror)
+            outcomes[mirror] = (STATUS_UNREACHABLE, None)
+        elif not probe['error'] is None:
+            lgr.error("Cannot fetch '%s/%s': %s"
+                      % (mirror_url, stampfile, probe['error']))
+            outcomes[mirror] = (STATUS_FAILED, None)
+        else:
+            outcomes[mirror] = _assess_stamp(mirror, probe['result'], now,
+                                             warn_threshold)
+        records.append((now, mirror) + outcomes[mirror]
+                       + (probe['elapsed'],))
+    metrics.inc('mirror_probes', len(records))
+    metrics.set_gauge('mirrors', len(outcomes))
+    metrics.set_gauge('mirrors_reachable',
+                      len([o for o in outcomes.values()
+                           if o[0] in REACHABLE_STATUSES]))
+    metrics.set_gauge('mirrors_up_to_date',
+                      len([o for o in outcomes.values()
+                           if o[0] == STATUS_OK]))
+    return outcomes, records
+
+
+def _render_page(template, mirror_urls, outcomes, history, stats_days,
+                 **kwargs):
+    # last timestamp ever obtained from each mirror
+    last_known = history.get_latest(with_stamp=True)
+    now = time.time()
+    mirrors_info = {}
+    for mirror, mirror_url in mirror_urls.items():
         mirror_name = cfg.get('mirror names', mirror)
 
         age = None
         age_str = None
-        status = "**N/A**"
-
-        try:
-            url = '%(mirror_url)s/%(stampfile)s' % locals()
-            u = urllib.request.urlopen(url)
-            stamp = u.read()
-            age = (time.time() - int(stamp))   # age in hours
+        status, stamp = outcomes[mirror]
+        if not stamp is None:
+            age = now - stamp
             age_str = _literal_seconds(age)
-            if age > warn_threshold:
-                lgr.warning("Mirror %(mirror)s is %(age_str)s old", locals())
-                status = "**OLD**"
-            else:
-                status = "OK"
-        except urllib.error.URLError as e:
-            lgr.error("Cannot fetch '%s': %s" % (url, e))
-            # Here ideally we should revert to use previously known state
-        except (TypeError, ValueError):
-            # int conversion has failed -- there is smth else in that file
-            lgr.error("Cannot assess the age. Retrieved stamp was %r" % stamp)
-            status = "**BRK**"
+        elif status in (STATUS_FAILED, STATUS_UNREACHABLE) \
+                and mirror in last_known:
+            # revert to the previously known state
+            age = now - last_known[mirror][3]
+            age_str = '%s (last known)' % _literal_seconds(age)
+
+        mirrors_info[mirror] = [mirror_url, mirror_name, age, age_str,
+                                STATUS_LABELS.get(status, status)]
+
+    return template.render(
+        timestamp=now,
+        info=mirrors_info,
+        stats=history.get_stats(now - stats_days * 86400, now),
+        stats_days=stats_days,
+        code2name=dict([(r, cfg.get('release names', r, r))
+                        for r in get_release_paths()]),
+        **kwargs)
+
+
+def _run_daemon(args, template, mirror_urls, history, stampfile, timeout,
+                deadline, warn_threshold, stats_days, keep_days):
+    interval = args.interval
+    if interval is None:
+        interval = cfg.get_as_dtype('mirrors monitor', 'interval', float, 600)
+    max_backoff = args.max_backoff
+    if max_backoff is None:
+        max_backoff = cfg.get_as_dtype('mirrors monitor', 'max backoff',
+                                       float, 21600)
+    pool = ConnectionPool()
+    fetch = lambda url: pool.fetch(url, timeout)
+    page_path = opj(args.dest_dir, 'mirrors_status.rst')
+    # start from the last recorded state
+    outcomes = dict([(m, (STATUS_FAILED, None)) for m in mirror_urls])
+    for mirror, rec in history.get_latest().items():
+        if mirror in outcomes:
+            outcomes[mirror] = rec[2:4]
+    failures = dict([(m, 0) for m in mirror_urls])
+    next_probe = dict([(m, 0) for m in mirror_urls])
+    rendered = None
+    try:
+        while True:
+            now = time.time()
+            due = dict([(m, url) for m, url in mirror_urls.items()
+                        if next_probe[m] <= now])
+            if len(due):
+                new_outcomes, records = _probe_stamps(
+                    due, stampfile, fetch, args.jobs, deadline, warn_threshold)
+                history.append(records)
+                if keep_days > 0:
+                    history.prune(now - keep_days * 86400)
+                for mirror, outcome in new_outcomes.items():
+                    if outcome[0] in (STATUS_FAILED, STATUS_UNREACHABLE):
+                        failures[mirror] += 1
+                        delay = min(interval * 2 ** failures[mirror],
+                                    max_backoff)
+                        lgr.info("next probe of mirror %s in %i seconds"
+                                 % (mirror, delay))
+                    else:
+                        failures[mirror] = 0
+                        delay = interval
+                    next_probe[mirror] = time.time() + delay
+                outcomes.update(new_outcomes)
+            state = dict([(m, o[0]) for m, o in outcomes.items()])
+            if state != rendered:
+                lgr.info("mirror status changed, updating page")
+                write_if_changed(
+                    _render_page(template, mirror_urls, outcomes, history,
+                                 stats_days),
+                    page_path)
+                rendered = state
+            time.sleep(max(0, min(next_probe.values()) - time.time()))
+    except KeyboardInterrupt:
+        lgr.info("stop monitoring mirrors")
+    finally:
+        pool.close()
 
-        mirrors_info[mirror] = [mirror_url, mirror_name, age, age_str, status]
 
-    page = template.render(
-        timestamp=time.time(),
-        info=mirrors_info)
+def run(args):
+    template = get_template('mirrors_status.rst')
+
+    stampfile = cfg.get('mirrors monitor', 'stampfile', 'TIMESTAMP')
+    warn_threshold = cfg.getfloat('mirrors monitor', 'warn-threshold') * 3600
+    timeout = args.timeout
+    if timeout is None:
+        timeout = cfg.get_as_dtype('mirrors monitor', 'timeout', float,
+                                   DEFAULT_TIMEOUT)
+    deadline = args.deadline
+    if deadline is None:
+        deadline = cfg.get_as_dtype('mirrors monitor', 'deadline', float,
+                                    DEFAULT_DEADLINE)
+    stats_days = args.stats_days
+    if stats_days is None:
+        stats_days = cfg.get_as_dtype('mirrors monitor', 'stats days', float,
+                                      7)
+    keep_days = args.keep_days
+    if keep_days is None:
+        keep_days = cfg.get_as_dtype('mirrors monitor', 'history days', float,
+                                     90)
+
+    lgr.debug("using stampfile %(stampfile)s", locals())
+
+    history = MirrorHistory(args.history)
+    mirror_urls = get_mirror_urls()
+    if args.daemon:
+        if args.benchmark or args.check_consistency or args.from_history:
+            lgr.warning("--benchmark, --check-consistency, and --from-history "
+                        "are ignored in daemon mode")
+        if not len(mirror_urls):
+            raise ValueError("no mirrors to monitor, add them to the 'mirrors' "
+                             "section of the configuration file")
+        _run_daemon(args, template, mirror_urls, history, stampfile, timeout,
+                    deadline, warn_threshold, stats_days, keep_days)
+        return
+    if args.from_history:
+        latest = history.get_latest()
+        outcomes = {}
+        for mirror in mirror_urls:
+            if mirror in latest:
+                outcomes[mirror] = latest[mirror][2:4]
+            else:
+                outcomes[mirror] = (STATUS_FAILED, None)
+    else:
+        outcomes, records = _probe_stamps(
+            mirror_urls, stampfile, lambda url: fetch_url(url, timeout),
+            args.jobs, deadline, warn_threshold)
+        history.append(records)
+        if keep_days > 0:
+            history.prune(time.time() - keep_days * 86400)
+
+    speed = None
+    reference = None
+    if args.benchmark:
+        reference = args.benchmark_file
+        if reference is None:
+            reference = _get_benchmark_file()
+        lgr.debug("measure mirror speed by downloading %s" % reference)
+        speed = _benchmark_mirrors(mirror_urls, reference, timeout, args.jobs,
+                                   deadline)
+        speed_json = args.speed_json
+        if speed_json is None:
+            speed_json = opj(args.dest_dir, 'mirrors_speed.json')
+        # ranked mirrors come first
+        fastest = None
+        if len(speed) and not speed[0]['rank'] is None:
+            fastest = speed[0]['mirror']
+        with open(speed_json, 'w') as f:
+            json.dump(dict(time=time.time(), reference=reference,
+                           mirrors=speed, fastest=fastest),
+                      f, indent=1, sort_keys=True)
 
-    with codecs.open(opj(args.dest_dir, 'mirrors_status.rst' ), 'wb', 'utf-8') as of:
-        of.write(page)
+    consistency = None
+    if args.check_consistency:
+        consistency = {}
+        for mirror, releases in _check_consistency(mirror_urls, timeout,
+                                                   args.jobs,
+                                                   deadline).items():
+            consistency[mirror] = dict(
+                [(r, (CONSISTENCY_LABELS[status], len(differ)))
+                 for r, (status, differ) in releases.items()])
 
+    write_if_changed(
+        _render_page(template, mirror_urls, outcomes, history, stats_days,
+                     speed=speed, speed_reference=reference,
+                     consistency=consistency),
+        opj(args.dest_dir, 'mirrors_status.rst'))
@@ -6,8 +6,19 @@
 #   copyright and license terms.
 #
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
-"""Generate package pages in reStructured Text format.
+"""Generate package pages in reStructured Text or HTML format.
 
+By default pages are generated in reStructured Text format, for further
+processing with Sphinx. With --format html pages are rendered straight to
+HTML, using the 'binary_pkg.html' template that extends a shared
+'layout.html' template. Stylesheets to be referenced by the HTML pages can be
+configured via the 'stylesheets' setting (a whitespace-separated list of URLs)
+in the 'html' section of the configuration.
+
+A page is only rendered if any of its inputs (package records, relevant
+configuration settings, or the template) changed since the last run.
+Fingerprints of these inputs are kept in the destination directory. Use
+--force to render all pages regardless.
 """
 
 __docformat__ = 'restructuredtext'
@@ -18,29 +29,58 @@ __docformat__ = 'restructuredtext'
 import argparse
 import os
 import re
-import codecs
 import logging
 import hashlib
 
 from os.path import join as opj
 
+import bigmess
 from bigmess import cfg
 from .helpers import parser_add_common_args
-from ..utils import load_db
+from ..utils import load_db, save_db, split_into_chunks, imap_forked, \
+        get_fingerprint, get_template_hash, load_fingerprints, get_template, \
+        get_cache_dir, get_page_writer, metrics
+from ..profiling import phase
+from ..pkgdescr import long_descr_to_rst, long_descr_to_html, \
+        DescriptionConverter
 
 lgr = logging.getLogger(__name__)
 parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
 
+# name of the file in the destination directory that records fingerprints of
+# the inputs of all rendered pages (for each output format)
+FINGERPRINTS_FILENAME = {'rst': '.bigmess_pkgs_fingerprints.gz',
+                         'html': '.bigmess_pkgs_html_fingerprints.gz'}
+# key of the context fingerprint (see get_context_fingerprint()) in the
+# fingerprint store -- never a package name
+CONTEXT_FINGERPRINT_KEY = ''
+# key of the fingerprint of the package DB all pages were last rendered from
+# (see get_rendered_db_fingerprint()) -- never a package name either
+DB_FINGERPRINT_KEY = '.db'
+# configuration settings read by the page templates (section, option)
+TEMPLATE_SETTINGS = (('metadata', 'source extracts baseurl'),
+                     ('html', 'stylesheets'))
+# long description converters for each output format
+DESCR_CONVERTERS = {'rst': long_descr_to_rst,
+                    'html': long_descr_to_html}
+
 
 def setup_parser(parser):
-    parser_add_common_args(parser, opt=('pkgdb',))
+    parser_add_common_args(parser, opt=('pkgdb', 'jobs', 'archive'))
     parser.add_argument('-d', '--dest-dir', default=os.curdir,
                         help="""target directory for storing the generated pages""")
     parser.add_argument('-t', '--template',
                         help="""Path to a custom template file""")
+    parser.add_argument('--format', choices=('rst', 'html'), default='rst',
+                        help="""output format of the generated pages.
+                        Default: rst""")
     parser.add_argument('--pkgs', '--packages',
                         nargs='+',
-                        help="""render pages for these binary packages""")
+                        help="""render pages for these binary packages (not
+                        with --archive)""")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="""render all pages, even if their inputs did not
+                        change since the last run""")
 
 
 def _underline_text(text, symbol):
@@ -48,115 +88,74 @@ def _underline_text(text, symbol):
     return '%s\n%s\n' % (text, underline)
 
 
-def _proc_long_descr(lines):
-    lines = [l.replace('% ', '%% ') for l in lines]
-    lines = [l.replace(r'\t', '    ') for l in lines]
-    re_leadblanks = re.compile("^ *")
-    re_itemized = re.compile("^[-o*+] +")
-    re_itemized_gr = re.compile("^( *)([-o*+] +)?(.*?)$")
-
-    def unwrap_lines(lines):
-        out = []
-        indent_levels = [-1]
-        for l in lines:
-            match = re_itemized_gr.search(l).groups()
-            if ((len(match[0]) in indent_levels and match[1] is None)
-                or (len(match[0]) > max(indent_levels) + 4)) \
-                and match[2].strip() != '.':
-                # append to previous
-                if not out[-1].endswith(" "):
-                    out[-1] += " "
-                out[-1] += match[2]
-            else:
-                out.append(l)
-
-            indent_levels = [len(match[0])]
-            if match[1] is not None:
-                indent_levels += [len(match[0]) + len(match[1])]
-            if match[2].strip() == '.':
-                # reset though if '.'
-                indent_levels = [-1]
-        return out
-
-    def dedent_withlevel(lines):
-        """Dedent `lines` given in a list provide dedented lines and
-        how much was dedented
-        """
-        nleading = min([re_leadblanks.search(l).span()[1]
-                        for l in lines])
-        return [l[nleading:] for l in lines], nleading
-
-    def block_lines(ld, level=0):
-        # so we got list of lines
-        # dedent all of them first
-        ld, level = dedent_withlevel(ld)
-
-        # lets collect them in blocks/paragraphs
-        # 1. into paragraphs split by '.'
-        blocks, block = [], None
-
-        # next block can begin if
-        #  1.  . line
-        #  2. it was an itemized list and all items begin with
-        #     the same symbol or get further indented accordingly
-        #     so let's first check if it is an itemized list
-        itemized_match = re_itemized.search(ld[0])
-        if itemized_match:
-            allow_indents = " " * itemized_match.span()[1]
-        else:
-            allow_indents = None
-        for l in ld:
-            if block is None or l.strip() == '.'\
-                    or (len(l) and (len(block) and (
-                        (l.startswith(' ') and not block[-1].startswith(' '))
-                        or
-                        (not l.startswith(' ') and block[-1].startswith(' '))))):
-                block = []
-                blocks.append(block)
-            if l.strip() != '.':
-                block.append(l)
-        if len(blocks) == 1:
-            return blocks[0]
-        else:
-            return [block_lines(b, level + 1) for b in blocks if len(b)]
-
-    def blocks_to_rst(bls, level=0):
-        # check if this block is an itemized beast
-        #itemized_match = re_itemized_gr.search(bls[0][0])
-        #if itemized_match:
-        #    res += ' 'allow_indents = " "*itemized_match.span()[1]
-        out = ''
-        for b in bls:
-            if isinstance(b, list):
-                if len(b) == 1:
-                    out += " " * level + b[0] + '\n\n'
-                else:
-                    out += blocks_to_rst(b, level + 1)
-            else:
-                e = " " * level + b + '\n'
-                if not re_itemized.search(b):
-                    pass
-                    #e += '\n'
-                elif len(e) and e[0] == ' ':
-                    # strip 1 leading blank
-                    e = e[1:]
-                out += e
-        out += '\n'
-        return out
-
-    ld = unwrap_lines(lines)
-    bls = block_lines(ld)
-    return blocks_to_rst(bls)
-
-
-def _gen_pkg_page(pname, db, pkg_template):
-    bindb = db['bin']
-    srcdb = db['src']
-    binpkginfo = bindb[pname]
-    srcpkginfo = srcdb[binpkginfo['src_name']]
+class SourceContexts(object):
+    """Parts of package page contexts that only depend on the source package.
+
+    They are computed once per source package on first access and are
+    shared by all binary packages built from this source.
+    """
+    def __init__(self, srcdb):
+        self._srcdb = srcdb
+        self._contexts = {}
+        self._release_names = {}
+
+    def get_release_name(self, codename):
+        """Return the configured (and memoized) name of a release"""
+        if not codename in self._release_names:
+            self._release_names[codename] = cfg.get('release names', codename)
+        return self._release_names[codename]
+
+    def __getitem__(self, src_name):
+        if not src_name in self._contexts:
+            self._contexts[src_name] = self._gen_context(src_name)
+        return self._contexts[src_name]
+
+    def _gen_context(self, src_name):
+        srcpkginfo = self._srcdb[src_name]
+        maintainers = ', '.join([srcpkginfo.get(field)
+                                 for field in ('maintainer', 'uploaders')
+                                 if len(srcpkginfo.get(field, ''))]).split(',')
+        maint_info = []
+        for m in maintainers:
+            if not len(m):
+                continue
+            mname, memail = re.match(r'(.*) <(.*)>', m).groups()
+            emailhash=hashlib.md5(memail.lower().strip().encode()).hexdigest(),
+            maint_info.append((mname, memail, emailhash))
+        # availability in base releases, used for releases without binaries
+        in_base_release = srcpkginfo.get('in_base_release', {})
+        base_availability = dict(
+            [(k, (self.get_release_name(k), [(v, '', [])]))
+             for k, v in in_base_release.items()])
+        return dict(info=srcpkginfo,
+                    maintainers=maint_info,
+                    in_base_release=in_base_release,
+                    base_availability=base_availability)
+
+
+def gen_pkg_page(pname, db, pkg_template, convert_descr=long_descr_to_rst,
+                 src_contexts=None):
+    """Render the page for a binary package.
+
+    Parameters
+    ----------
+    pname : str
+      Name of the binary package
+    db : dict
+      Package DB
+    pkg_template : jinja2.Template
+    convert_descr : callable
+      Converter for the long description of the package
+    src_contexts : SourceContexts or None
+      Per-source parts of page contexts shared across calls
+    """
+    if src_contexts is None:
+        src_contexts = SourceContexts(db['src'])
+    binpkginfo = db['bin'][pname]
+    src_context = src_contexts[binpkginfo['src_name']]
     pkginfo = {}
     pkginfo.update(binpkginfo)
-    pkginfo.update(srcpkginfo)
+    pkginfo.update(src_context['info'])
 
     if 'short_description' in pkginfo:
         title = _underline_text('**%s** -- %s' % (pname,
@@ -165,33 +164,23 @@ def _gen_pkg_page(pname, db, pkg_template):
     else:
         title = _underline_text('**%s**' % pname, '*')
     if 'long_description' in pkginfo:
-        long_descr = _proc_long_descr(pkginfo['long_description'])
+        long_descr = convert_descr(pkginfo['long_description'])
     else:
         long_descr = 'No description available.'
 
-    maintainers = ', '.join([srcpkginfo.get(field)
-                             for field in ('maintainer', 'uploaders')
-                             if len(srcpkginfo.get(field, ''))]).split(',')
-    maint_info = []
-    for m in maintainers:
-        if not len(m):
-            continue
-        mname, memail = re.match(r'(.*) <(.*)>', m).groups()
-        emailhash=hashlib.md5(memail.lower().strip().encode()).hexdigest(),
-        maint_info.append((mname, memail, emailhash))
-    in_base_release = srcpkginfo.get('in_base_release', {})
+    in_base_release = src_context['in_base_release']
     in_release = binpkginfo['in_release']
-    availability = {}
-    for k in set(list(in_release.keys()) + list(in_base_release.keys())):
-        release = cfg.get('release names', k)
-        versions = in_release.get(k, None)
+    availability = dict([avail
+                         for k, avail in src_context['base_availability'].items()
+                         if not k in in_release])
+    for k, versions in in_release.items():
         base_version = in_base_release.get(k, '')
         if not versions:
-            availability[release] = [(base_version, '', [])]
+            avail = [(base_version, '', [])]
         else:
             # List the same base version for every item in versions
-            availability[release] = [(base_version, v_, a_)
-                                     for v_, a_ in in_release[k].items()]
+            avail = [(base_version, v_, a_) for v_, a_ in versions.items()]
+        availability[src_contexts.get_release_name(k)] = avail
 
     page = pkg_template.render(
         cfg=cfg,
@@ -199,34 +188,227 @@ def _gen_pkg_page(pname, db, pkg_template):
         title=title,
         description=long_descr,
         availability=availability,
-        maintainers=maint_info,
+        maintainers=src_context['maintainers'],
         **pkginfo)
     return page
 
 
-def run(args):
-    from jinja2 import Environment, PackageLoader, FileSystemLoader
-    lgr.debug("using package DB at '%s'" % args.pkgdb)
-    if not args.template is None:
-        templ_dir = os.path.dirname(args.template)
-        templ_basename = os.path.basename(args.template)
-        jinja_env = Environment(loader=FileSystemLoader(templ_dir))
-        template = jinja_env.get_template(templ_basename)
+def _get_template_settings():
+    return [cfg.get(section, option)
+            for section, option in TEMPLATE_SETTINGS]
+
+
+def get_page_fingerprint(pname, db, template_hash):
+    """Return a fingerprint of everything that influences a package page"""
+    binpkginfo = db['bin'][pname]
+    srcpkginfo = db['src'][binpkginfo['src_name']]
+    releases = set(binpkginfo['in_release']).union(
+        srcpkginfo.get('in_base_release', {}))
+    return get_fingerprint(
+        bigmess.__version__,
+        template_hash,
+        pname,
+        binpkginfo,
+        srcpkginfo,
+        [(r, cfg.get('release names', r)) for r in sorted(releases)],
+        _get_template_settings())
+
+
+def get_context_fingerprint(template_hash):
+    """Return a fingerprint of everything that influences all package pages.
+
+    It covers everything in get_page_fingerprint() that is not taken from the
+    package DB.
+    """
+    if cfg.has_section('release names'):
+        release_names = sorted(cfg.items('release names'))
     else:
-        jinja_env = Environment(loader=PackageLoader('bigmess'))
-        template = jinja_env.get_template('binary_pkg.rst')
-    # read entire DB
-    db = load_db(args.pkgdb)
-    if args.pkgs is None:
+        release_names = []
+    return get_fingerprint(
+        bigmess.__version__,
+        template_hash,
+        release_names,
+        _get_template_settings())
+
+
+def get_rendered_db_fingerprint(dest_dir, fmt='rst'):
+    """Return the fingerprint of the package DB the pages were rendered from.
+
+    Returns
+    -------
+    str or None
+      Fingerprint of the package DB (see get_fingerprint()) that the last
+      run rendering pages for all packages in ``dest_dir`` was based on, or
+      None if unknown.
+    """
+    return load_fingerprints(
+        opj(dest_dir, FINGERPRINTS_FILENAME[fmt])).get(DB_FINGERPRINT_KEY)
+
+
+# state shared with worker processes -- populated before any process is
+# forked, hence the package DB is inherited instead of being pickled
+_render_state = {}
+
+
+def _render_pkgs(pkgs):
+    db = _render_state['db']
+    template = _render_state['template']
+    ext = _render_state['ext']
+    template_hash = _render_state['template_hash']
+    writer = _render_state['writer']
+    last_fprints = _render_state['fingerprints']
+    convert_descr = _render_state['descr_converter']
+    src_contexts = SourceContexts(db['src'])
+    res = dict(fingerprints={}, pages=[], written=0, unchanged=0, skipped=0)
+    unchanged = _render_state['unchanged']
+    for pkg in pkgs:
+        if pkg in unchanged and pkg in last_fprints:
+            fprint = last_fprints[pkg]
+        else:
+            fprint = get_page_fingerprint(pkg, db, template_hash)
+        res['fingerprints'][pkg] = fprint
+        fname = '%s.%s' % (pkg, ext)
+        if not writer is None and last_fprints.get(pkg) == fprint \
+                and os.path.exists(opj(writer.dest_dir, fname)):
+            res['skipped'] += 1
+            continue
+        lgr.debug("render page for '%s'" % pkg)
+        page = gen_pkg_page(pkg, db, template, convert_descr, src_contexts)
+        if writer is None:
+            # archive output is written by the parent process
+            res['pages'].append((fname, page))
+        elif writer.write_page(fname, page):
+            res['written'] += 1
+        else:
+            res['unchanged'] += 1
+    res['descriptions'] = convert_descr.pop_new()
+    return res
+
+
+def render_pkg_pages(db, dest_dir, fmt='rst', template=None, jobs=1,
+                     archive=None, pkgs=None, force=False, unchanged=None):
+    """Render the pages of binary packages.
+
+    Pages are only rendered if their inputs changed since the last run, or
+    if they are missing (see get_page_fingerprint()).
+
+    Parameters
+    ----------
+    db : dict
+      Package DB
+    dest_dir : str
+      Directory to write the pages into. It also holds the fingerprints of
+      all page inputs.
+    fmt : {'rst', 'html'}
+      Output format
+    template : str or None
+      Path to a custom template
+    jobs : int
+      Number of worker processes
+    archive : str or None
+      If not None, write all pages into a tar archive at this location.
+    pkgs : list or None
+      Names of the binary packages to render pages for. By default, for all
+      packages in the DB.
+    force : bool
+      If True, render all pages, regardless of their inputs.
+    unchanged : set or None
+      Names of binary packages known to have the same DB records (and source
+      package records) as in the DB the existing pages were rendered from
+      (see get_rendered_db_fingerprint()). Their fingerprints are reused
+      instead of being recomputed, unless anything else that influences all
+      pages (template, configuration, ...) changed too.
+
+    Returns
+    -------
+    dict
+      Numbers of pages ``written``, ``unchanged`` (rendered, but identical
+      to the existing file), and ``skipped`` (inputs unchanged).
+    """
+    template = get_template('binary_pkg.%s' % fmt, template)
+    all_pkgs = pkgs is None
+    if all_pkgs:
         lgr.debug("render pages for all known binary packages")
         pkgs = db['bin']
     else:
         lgr.debug("render pages given list of binary packages only")
-        pkgs = args.pkgs
 
-    for pkg in pkgs:
-        lgr.debug("render page for '%s'" % pkg)
-        page = _gen_pkg_page(pkg, db, template)
-        of = codecs.open(opj(args.dest_dir, '%s.rst' % pkg), 'wb', 'utf-8')
-        of.write(page)
-        of.close()
+    # keep binaries from the same source together, so they end up in the
+    # same chunk and can share the per-source part of the page context
+    pkgs = sorted(pkgs, key=lambda p: (db['bin'][p]['src_name'], p))
+    template_hash = get_template_hash(template)
+    context_fprint = get_context_fingerprint(template_hash)
+    # fingerprints of all page inputs as of the last run
+    fprints_path = opj(dest_dir, FINGERPRINTS_FILENAME[fmt])
+    if force or not archive is None:
+        # an archive always needs to contain all pages
+        last_fprints = {}
+    else:
+        last_fprints = load_fingerprints(fprints_path)
+    if unchanged is None \
+            or last_fprints.get(CONTEXT_FINGERPRINT_KEY) != context_fprint:
+        unchanged = set()
+    descr_converter = DescriptionConverter(
+        opj(get_cache_dir(), 'descr_%s_cache.gz' % fmt),
+        DESCR_CONVERTERS[fmt])
+    # make everything available to the worker processes before they are forked
+    _render_state.update(db=db, template=template, ext=fmt,
+                         template_hash=template_hash,
+                         fingerprints=last_fprints,
+                         unchanged=unchanged,
+                         descr_converter=descr_converter)
+    chunks = split_into_chunks(pkgs, jobs * 4)
+    if all_pkgs:
+        # start from scratch to forget about packages that are gone
+        fprints = {CONTEXT_FINGERPRINT_KEY: context_fprint,
+                   DB_FINGERPRINT_KEY: get_fingerprint(db)}
+    else:
+        fprints = load_fingerprints(fprints_path)
+        if fprints.get(CONTEXT_FINGERPRINT_KEY) != context_fprint:
+            # other fingerprints are based on a different context
+            fprints.pop(CONTEXT_FINGERPRINT_KEY, None)
+        # the pages no longer share a common DB
+        fprints.pop(DB_FINGERPRINT_KEY, None)
+    counts = dict(written=0, unchanged=0, skipped=0)
+    with phase('render'):
+        with get_page_writer(dest_dir, archive) as writer:
+            if archive is None:
+                _render_state['writer'] = writer
+            else:
+                # workers hand pages to this process for archiving
+                _render_state['writer'] = None
+            for res in imap_forked(_render_pkgs, chunks, jobs):
+                for fname, page in res['pages']:
+                    writer.write_page(fname, page)
+                    counts['written'] += 1
+                for c in counts:
+                    counts[c] += res[c]
+                fprints.update(res['fingerprints'])
+                descr_converter.update(res['descriptions'])
+    for c in counts:
+        metrics.inc('package_pages_%s' % c, counts[c])
+    with phase('write'):
+        if archive is None:
+            save_db(fprints, fprints_path)
+        # only the full DB tells which cached results are still needed
+        if all_pkgs:
+            descr_converter.prune([p['long_description']
+                                   for p in db['bin'].values()
+                                   if 'long_description' in p])
+        descr_converter.save()
+    lgr.info("package pages: %(written)i written, %(unchanged)i unchanged, "
+             "%(skipped)i skipped (inputs unchanged)" % counts)
+    return counts
+
+
+def run(args):
+    if not args.archive is None and not args.pkgs is None:
+        # the archive would replace one with all pages
+        raise ValueError("--archive cannot be combined with --pkgs, an archive "
+                         "always contains the pages of all packages")
+    lgr.debug("using package DB at '%s'" % args.pkgdb)
+    # read entire DB
+    with phase('parse'):
+        db = load_db(args.pkgdb)
+    render_pkg_pages(db, args.dest_dir, args.format, args.template, args.jobs,
+                     args.archive, args.pkgs, args.force)
@@ -9,6 +9,16 @@
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
 """Generate table of contents pages for packages sort by various criteria.
 
+A page is only rendered if its group of packages, the binary packages and
+short descriptions of its members, or the template changed since the last run.
+Fingerprints of these inputs are kept in the destination directory. Use
+--force to render all pages regardless.
+
+TOCs of more than --page-size source packages are split into several pages.
+The page of such a TOC (and the TOC of TOCs) then only links its parts. With
+--split-by initial, parts are formed by the initial of package names (the
+same grouping as in the pool of a Debian archive), and only initials with
+more than --page-size packages are split further.
 """
 
 __docformat__ = 'restructuredtext'
@@ -18,23 +28,30 @@ __docformat__ = 'restructuredtext'
 
 import argparse
 import os
-import re
 import logging
-import codecs
 import hashlib
 
 from os.path import join as opj
 
+import bigmess
 from bigmess import cfg
 from .helpers import parser_add_common_args
-from ..utils import load_db
+from ..utils import load_db, save_db, get_template, get_page_writer, \
+        get_fingerprint, get_template_hash, load_fingerprints, \
+        split_into_chunks, imap_forked, metrics
+from ..dbindex import build_index
+from ..profiling import phase
 
 lgr = logging.getLogger(__name__)
 parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
 
+# name of the file in the destination directory that records fingerprints of
+# the inputs of all rendered TOC pages
+FINGERPRINTS_FILENAME = '.bigmess_tocs_fingerprints.gz'
+
 
 def setup_parser(parser):
-    parser_add_common_args(parser, opt=('pkgdb',))
+    parser_add_common_args(parser, opt=('pkgdb', 'jobs', 'archive'))
     parser.add_argument('-d', '--dest-dir', default=os.curdir,
                         help="""target directory for storing the generated pages""")
     parser.add_argument('-b', '--binpkgtoc-template',
@@ -43,130 +60,330 @@ def setup_parser(parser):
                         help="""Path to a custom template file for a table of contents of source packages""")
     parser.add_argument('-a', '--pkgtoc-template',
                         help="""Path to a custom template file for a table of contents of all packages""")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="""render all pages, even if their inputs did not
+                        change since the last run""")
+    parser.add_argument('--page-size', type=int, default=0, metavar='N',
+                        help="""split TOCs of more than N source packages into
+                        several pages. Default: no splitting""")
+    parser.add_argument('--split-by', choices=('count', 'initial'),
+                        default='count',
+                        help="""how to split large TOCs: into pages of at most
+                        N packages each, or by package name initials.
+                        Default: count""")
 
 
-def _write_page(page, destdir, fname):
-    of = codecs.open(opj(destdir, '%s.rst' % fname), 'wb', 'utf-8')
-    of.write(page)
-    of.close()
+def _sort_names(names):
+    # same order as jinja's (case-insensitive) sort filter
+    return sorted(names, key=str.lower)
 
 
-def run(args):
-    from jinja2 import Environment as JinjaEnvironment
-    from jinja2 import PackageLoader as JinjaPackageLoader
-    from jinja2 import FileSystemLoader as JinjaFileSystemLoader
-    lgr.debug("using package DB at '%s'" % args.pkgdb)
-    # read entire DB
-    db = load_db(args.pkgdb)
-    bindb = db['bin']
+def get_toc_specs(db):
+    """Determine all table of contents pages for a package DB.
+
+    Parameters
+    ----------
+    db : dict
+      Package DB
+
+    Returns
+    -------
+    dict
+      TOC page specifications by page label. Each specification is a dict
+      with the keys ``kind`` ('release', 'field', 'maintainer', or 'all'),
+      ``label``, ``title``, ``pkgs`` (sorted names of source packages), and
+      ``extra`` (additional template variables). Specifications of the
+      parts of a split TOC (see paginate_toc_specs()) additionally have
+      a ``parent`` key with the label of the TOC they are a part of.
+    """
     srcdb = db['src']
     taskdb = db['task']
-    by_release = {}
-    by_maintainer = {}
-    maintainer_name = {}
-    by_task = {}
-    for pname, pkg in db['bin'].items():
-        src_name = pkg['src_name']
-        for release in pkg['in_release']:
-            by_release[release] = by_release.get(release, set()).union((src_name,))
-        if 'upstream' in srcdb[src_name] and 'Tags' in srcdb[src_name]['upstream']:
-            # we have some tags
-            for tag in srcdb[src_name]['upstream']['Tags']:
-                if tag.startswith('task::'):
-                    task = tag[6:]
-                    by_task[task] = by_task.get(task, set()).union((src_name,))
-        maintainer = srcdb[pkg['src_name']]['maintainer']
-        uploaders = [u.strip() for u in srcdb[src_name]['uploaders'].split(',')]
-        for maint in uploaders + [maintainer]:
-            if not len(maint.strip()):
-                continue
-            try:
-                mname, memail = re.match(r'(.*) <(.*)>', maint).groups()
-            except AttributeError:
-                lgr.warning('malformed maintainer listing for %s: %s' % (pname, maint))
-                mname = memail = maint
-            # normalize
-            memail = memail.lower()
-            maintainer_name[memail] = mname
-            by_maintainer[memail] = by_maintainer.get(memail, set()).union((src_name,))
-        # XXX extend when blend is ready
-
-    # write TOCs for all releases
-    if not args.binpkgtoc_template is None:
-        templ_dir = os.path.dirname(args.binpkgtoc_template)
-        templ_basename = os.path.basename(args.binpkgtoc_template)
-        jinja_env = JinjaEnvironment(loader=JinjaFileSystemLoader(templ_dir))
-        bintoc_template = jinja_env.get_template(templ_basename)
-        raise NotImplemented("need to define srctoc_template")
-    else:
-        jinja_env = JinjaEnvironment(loader=JinjaPackageLoader('bigmess'))
-        bintoc_template = jinja_env.get_template('binpkg_toc.rst')
-        srctoc_template = jinja_env.get_template('srcpkg_toc.rst')
+    index = build_index(db)
+
+    specs = {}
+
+    def add_spec(kind, label, title, pkgs, **extra):
+        specs[label] = dict(kind=kind, label=label, title=title, pkgs=pkgs,
+                            extra=extra)
+
+    for release_name, release_content in index['release'].items():
+        add_spec('release',
+                 'toc_pkgs_for_release_%s' % release_name,
+                 'Packages for %s' % cfg.get('release names', release_name),
+                 _sort_names(release_content))
+    for task_name, task_content in index['task'].items():
+        add_spec('field',
+                 'toc_pkgs_for_field_%s' % task_name,
+                 'Packages for %s' % taskdb[task_name],
+                 _sort_names(task_content))
+    add_spec('all', 'toc_all_pkgs', 'Complete package list',
+             _sort_names(srcdb.keys()))
+    for memail, mpkgs in index['maintainer'].items():
+        add_spec('maintainer',
+                 'toc_pkgs_for_maintainer_%s' % memail.replace('@', '_at_'),
+                 'Packages made by %s <%s>' % (index['maintainer_name'][memail],
+                                               memail),
+                 _sort_names(mpkgs),
+                 emailhash=hashlib.md5(memail.lower().strip().encode()).hexdigest())
+    return specs
+
+
+def _get_initial(name):
+    # same as the subdirectory of a package in a Debian archive pool
+    name = name.lower()
+    if name.startswith('lib') and len(name) > 3:
+        return name[:4]
+    return name[:1]
+
+
+def _split_pages(pkgs, page_size):
+    return [pkgs[i:i + page_size] for i in range(0, len(pkgs), page_size)]
+
+
+def paginate_toc_specs(specs, page_size, by_initial=False):
+    """Split TOCs with many packages into several pages.
+
+    Parameters
+    ----------
+    specs : dict
+      TOC page specifications (see get_toc_specs())
+    page_size : int
+      Maximum number of source packages per page. No TOC is split if less
+      than one.
+    by_initial : bool
+      If True, parts are formed by the initials of package names first, and
+      only initials with more than ``page_size`` packages are split further.
+
+    Returns
+    -------
+    dict
+      TOC page specifications by page label. The specification of a TOC
+      that was split has no packages and an additional template variable
+      ``pages`` listing ``(label, caption)`` tuples of its parts.
+    """
+    paged = {}
+    for label, spec in specs.items():
+        pkgs = spec['pkgs']
+        if page_size < 1 or len(pkgs) <= page_size:
+            paged[label] = spec
+            continue
+        parts = []
+        if by_initial:
+            initials = {}
+            for pkg in pkgs:
+                initials.setdefault(_get_initial(pkg), []).append(pkg)
+            for initial in sorted(initials):
+                ipkgs = initials[initial]
+                if len(ipkgs) <= page_size:
+                    parts.append((initial, initial, ipkgs))
+                    continue
+                for i, ppkgs in enumerate(_split_pages(ipkgs, page_size)):
+                    parts.append(('%s_p%i' % (initial, i + 1),
+                                  '%s .. %s' % (ppkgs[0], ppkgs[-1]),
+                                  ppkgs))
+        else:
+            for i, ppkgs in enumerate(_split_pages(pkgs, page_size)):
+                parts.append(('p%i' % (i + 1),
+                              '%s .. %s' % (ppkgs[0], ppkgs[-1]),
+                              ppkgs))
+        pages = []
+        for suffix, caption, ppkgs in parts:
+            plabel = '%s_%s' % (label, suffix)
+            paged[plabel] = dict(kind=spec['kind'], label=plabel,
+                                 title='%s (%s)' % (spec['title'], caption),
+                                 pkgs=ppkgs, extra=spec['extra'],
+                                 parent=label)
+            pages.append((plabel, caption))
+        paged[label] = dict(spec, pkgs=[],
+                            extra=dict(spec['extra'], pages=pages))
+    return paged
+
+
+def get_sorted_binaries(db, pkgs=None):
+    """Return the sorted names of the binary packages of source packages.
+
+    Parameters
+    ----------
+    db : dict
+      Package DB
+    pkgs : iterable or None
+      Names of source packages. If None, all source packages in the DB are
+      considered.
+
+    Returns
+    -------
+    dict
+      Sorted list of binary package names by source package name.
+    """
+    srcdb = db['src']
+    if pkgs is None:
+        pkgs = srcdb
+    return dict([(s, _sort_names(srcdb[s].get('binary', []))) for s in pkgs])
+
+
+def get_toctoc(specs):
+    """Return the content of the TOC of TOCs: titles by label for each kind"""
     toctoc = {'release': {}, 'maintainer': {}, 'field': {}}
-    release_tocs = toctoc['release']
-    for release_name, release_content in by_release.items():
-        label = 'toc_pkgs_for_release_%s' % release_name
-        title = 'Packages for %s' % cfg.get('release names', release_name)
-        release_tocs[label] = title
-        page = srctoc_template.render(cfg=cfg,
-                                      label=label,
-                                      title=title,
-                                      pkgs=release_content,
-                                      srcdb=srcdb,
-                                      bindb=bindb)
-        _write_page(page, args.dest_dir, label)
-    task_tocs = toctoc['field']
-    for task_name, task_content in by_task.items():
-        label = 'toc_pkgs_for_field_%s' % task_name
-        title = 'Packages for %s' % taskdb[task_name]
-        task_tocs[label] = title
-        page = srctoc_template.render(cfg=cfg,
-                                      label=label,
-                                      title=title,
-                                      pkgs=set(task_content),
-                                      srcdb=srcdb,
-                                      bindb=bindb)
-        _write_page(page, args.dest_dir, label)
-    # full TOC
-    _write_page(srctoc_template.render(cfg=cfg,
-                                       label='toc_all_pkgs',
-                                       title='Complete package list',
-                                       pkgs=list(srcdb.keys()),
-                                       srcdb=srcdb,
-                                       bindb=bindb),
-                args.dest_dir,
-                'toc_all_pkgs')
-    # TOC by maintainer
-    if not args.srcpkgtoc_template is None:
-        templ_dir = os.path.dirname(args.srcpkgtoc_template)
-        templ_basename = os.path.basename(args.srcpkgtoc_template)
-        jinja_env = JinjaEnvironment(loader=JinjaFileSystemLoader(templ_dir))
-        srctoc_template = jinja_env.get_template(templ_basename)
+    for label, spec in specs.items():
+        if spec['kind'] in toctoc and not 'parent' in spec:
+            toctoc[spec['kind']][label] = spec['title']
+    return toctoc
+
+
+def get_toc_pages(specs):
+    """Return the pages of all split TOCs: (label, caption) tuples by label"""
+    return dict([(label, spec['extra']['pages'])
+                 for label, spec in specs.items()
+                 if 'pages' in spec['extra']])
+
+
+def get_toc_fingerprint(spec, db, template_hash, binaries=None):
+    """Return a fingerprint of everything that influences a TOC page
+
+    ``binaries`` is the output of get_sorted_binaries(), if already available.
+    """
+    bindb = db['bin']
+    if binaries is None:
+        binaries = get_sorted_binaries(db, spec['pkgs'])
+    members = [(s, [(b, bindb.get(b, {}).get('short_description'))
+                    for b in binaries[s]])
+               for s in spec['pkgs']]
+    return get_fingerprint(bigmess.__version__,
+                           template_hash,
+                           spec['label'],
+                           spec['title'],
+                           spec['extra'],
+                           members)
+
+
+def render_toc_page(spec, template, db, binaries=None):
+    """Render a TOC page from its specification (see get_toc_specs())
+
+    ``binaries`` is the output of get_sorted_binaries(), if already available.
+    """
+    if binaries is None:
+        binaries = get_sorted_binaries(db, spec['pkgs'])
+    return template.render(cfg=cfg,
+                           label=spec['label'],
+                           title=spec['title'],
+                           pkgs=spec['pkgs'],
+                           binaries=binaries,
+                           srcdb=db['src'],
+                           bindb=db['bin'],
+                           **spec['extra'])
+
+
+_render_state = {}
+
+
+def _render_tocs(labels):
+    db = _render_state['db']
+    specs = _render_state['specs']
+    binaries = _render_state['binaries']
+    writer = _render_state['writer']
+    last_fprints = _render_state['fingerprints']
+    res = dict(fingerprints={}, pages=[], written=0, unchanged=0, skipped=0)
+    for label in labels:
+        spec = specs[label]
+        template, template_hash = _render_state['templates'][spec['kind']]
+        fprint = get_toc_fingerprint(spec, db, template_hash, binaries)
+        res['fingerprints'][label] = fprint
+        fname = '%s.rst' % label
+        if not writer is None and last_fprints.get(label) == fprint \
+                and os.path.exists(opj(writer.dest_dir, fname)):
+            res['skipped'] += 1
+            continue
+        lgr.debug("render TOC page '%s'" % label)
+        page = render_toc_page(spec, template, db, binaries)
+        if writer is None:
+            # archive output is written by the parent process
+            res['pages'].append((fname, page))
+        elif writer.write_page(fname, page):
+            res['written'] += 1
+        else:
+            res['unchanged'] += 1
+    return res
+
+
+def render_toc_pages(db, dest_dir, jobs=1, archive=None, force=False,
+                     page_size=0, split_by='count', binpkgtoc_template=None,
+                     srcpkgtoc_template=None, pkgtoc_template=None):
+    """Render all TOC pages, and the TOC of TOCs.
+
+    TOC pages are only rendered if their inputs changed since the last run,
+    or if they are missing (see get_toc_fingerprint()). Parameters match the
+    command line options of the mkpkgtocs command.
+
+    Returns
+    -------
+    str
+      The TOC of TOCs
+    """
+    specs = paginate_toc_specs(get_toc_specs(db), page_size,
+                               by_initial=split_by == 'initial')
+
+    bintoc_template = get_template('binpkg_toc.rst', binpkgtoc_template)
+    if not binpkgtoc_template is None:
+        raise NotImplemented("need to define srctoc_template")
+    srctoc_template = get_template('srcpkg_toc.rst')
+    # TOCs by maintainer can use a custom template
+    mainttoc_template = get_template('srcpkg_toc.rst', srcpkgtoc_template)
+    templates = {}
+    for kind in ('release', 'field', 'all', 'maintainer'):
+        if kind == 'maintainer':
+            template = mainttoc_template
+        else:
+            template = srctoc_template
+        templates[kind] = (template, get_template_hash(template))
+
+    fprints_path = opj(dest_dir, FINGERPRINTS_FILENAME)
+    if force or not archive is None:
+        # an archive always needs to contain all pages
+        last_fprints = {}
     else:
-        jinja_env = JinjaEnvironment(loader=JinjaPackageLoader('bigmess'))
-        srctoc_template = jinja_env.get_template('srcpkg_toc.rst')
-    maintainer_tocs = toctoc['maintainer']
-    for memail, mpkgs in by_maintainer.items():
-        label = 'toc_pkgs_for_maintainer_%s' % memail.replace('@', '_at_')
-        title = 'Packages made by %s <%s>' % (maintainer_name[memail], memail)
-        maintainer_tocs[label] = title
-        page = srctoc_template.render(
-            cfg=cfg,
-            label=label,
-            title=title,
-            emailhash=hashlib.md5(memail.lower().strip().encode()).hexdigest(),
-            pkgs=mpkgs,
-            srcdb=srcdb,
-            bindb=bindb)
-        _write_page(page, args.dest_dir, label)
+        last_fprints = load_fingerprints(fprints_path)
+    # make everything available to the worker processes before they are forked
+    _render_state.update(db=db, specs=specs, templates=templates,
+                         binaries=get_sorted_binaries(db),
+                         fingerprints=last_fprints)
+    chunks = split_into_chunks(sorted(specs), jobs * 4)
+    fprints = {}
+    counts = dict(written=0, unchanged=0, skipped=0)
+    with phase('render'):
+        with get_page_writer(dest_dir, archive) as writer:
+            if archive is None:
+                _render_state['writer'] = writer
+            else:
+                # workers hand pages to this process for archiving
+                _render_state['writer'] = None
+            for res in imap_forked(_render_tocs, chunks, jobs):
+                for fname, page in res['pages']:
+                    writer.write_page(fname, page)
+                    counts['written'] += 1
+                for c in counts:
+                    counts[c] += res[c]
+                fprints.update(res['fingerprints'])
+    for c in counts:
+        metrics.inc('toc_pages_%s' % c, counts[c])
+    if archive is None:
+        with phase('write'):
+            save_db(fprints, fprints_path)
 
     # TOC of TOCs
-    if not args.pkgtoc_template is None:
-        templ_dir = os.path.dirname(args.pkgtoc_template)
-        templ_basename = os.path.basename(args.pkgtoc_template)
-        jinja_env = JinjaEnvironment(loader=JinjaFileSystemLoader(templ_dir))
-        toctoc_template = jinja_env.get_template(templ_basename)
-    else:
-        jinja_env = JinjaEnvironment(loader=JinjaPackageLoader('bigmess'))
-        toctoc_template = jinja_env.get_template('pkg_tocs.rst')
-    print(toctoc_template.render(toctoc=toctoc), 'utf-8')
+    toctoc_template = get_template('pkg_tocs.rst', pkgtoc_template)
+    lgr.info("TOC pages: %(written)i written, %(unchanged)i unchanged, "
+             "%(skipped)i skipped (inputs unchanged)" % counts)
+    return toctoc_template.render(toctoc=get_toctoc(specs),
+                                  toc_pages=get_toc_pages(specs))
+
+
+def run(args):
+    lgr.debug("using package DB at '%s'" % args.pkgdb)
+    # read entire DB
+    with phase('parse'):
+        db = load_db(args.pkgdb)
+    toctoc = render_toc_pages(db, args.dest_dir, args.jobs, args.archive,
+                              args.force, args.page_size, args.split_by,
+                              args.binpkgtoc_template,
+                              args.srcpkgtoc_template, args.pkgtoc_template)
+    print(toctoc, 'utf-8')
@@ -27,6 +27,20 @@ renderer is provided with three dictionary containing all relevant information:
   Mapping of mirror code names to their respective repository URLs. If no
   mirrors are configured, this is an empty dictionary
 
+If mirror speed measurements (as stored by ``bigmess mkmirrorsstat
+--benchmark``) are given via --mirror-speed, two more variables are
+available:
+
+``mirror2speed``
+  Mapping of mirror code names to their measurements (download ``rank``,
+  ``connect`` time, time to first byte ``ttfb``, ``total`` download time,
+  ``throughput``). Mirrors without successful measurement have a ``rank``
+  of None
+
+``fastest_mirror``
+  Code name of the fastest mirror, or None if unknown. The shipped template
+  pre-selects this mirror
+
 The rendered template is written to stdout.
 """
 
@@ -36,11 +50,12 @@ __docformat__ = 'restructuredtext'
 # man: -*- % generate mirror selection HTML snippet
 
 import argparse
-import os
+import json
 import codecs
 import logging
 
 from bigmess import cfg
+from ..utils import get_template
 
 lgr = logging.getLogger(__name__)
 parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -49,11 +64,12 @@ parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
 def setup_parser(parser):
     parser.add_argument('-t', '--template',
                         help="""Path to a custom template file""")
+    parser.add_argument('--mirror-speed', metavar='PATH',
+                        help="""JSON file with mirror speed measurements, as
+                        generated by 'bigmess mkmirrorsstat --benchmark'""")
 
 
 def run(args):
-    from jinja2 import Environment, PackageLoader, FileSystemLoader
-
     mirror2name = {}
     mirror2url = {}
     code2relname = dict([(r, cfg.get('release names', r))
@@ -65,15 +81,22 @@ def run(args):
     if cfg.has_section('mirrors'):
         mirror2url = dict([(m, cfg.get('mirrors', m))
                            for m in cfg.options('mirrors')])
-    if not args.template is None:
-        templ_dir = os.path.dirname(args.template)
-        templ_basename = os.path.basename(args.template)
-        jinja_env = Environment(loader=FileSystemLoader(templ_dir))
-        srclist_template = jinja_env.get_template(templ_basename)
-    else:
-        jinja_env = Environment(loader=PackageLoader('bigmess'))
-        srclist_template = jinja_env.get_template('sources_lists.rst')
+    mirror2speed = {}
+    fastest_mirror = None
+    if not args.mirror_speed is None:
+        with open(args.mirror_speed) as f:
+            speed = json.load(f)
+        mirror2speed = dict([(m['mirror'], m) for m in speed['mirrors']])
+        fastest_mirror = speed['fastest']
+        if not fastest_mirror in mirror2url:
+            # measured mirror is no longer configured
+            ranked = [m['mirror'] for m in speed['mirrors']
+                      if not m['rank'] is None and m['mirror'] in mirror2url]
+            fastest_mirror = ranked[0] if len(ranked) else None
+    srclist_template = get_template('sources_lists.rst', args.template)
     print(
         srclist_template.render(code2name=code2relname,
                                 mirror2name=mirror2name,
-                                mirror2url=mirror2url))
+                                mirror2url=mirror2url,
+                                mirror2speed=mirror2speed,
+                                fastest_mirror=fastest_mirror))
@@ -0,0 +1,290 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Generate a search index of all binary packages for the package portal.
+
+The index is an inverted index that maps search terms to the binary packages
+they occur in. Terms are taken from package names, short and long
+descriptions, upstream tags, and the names and email addresses of the
+maintainers and uploaders of the source package. All terms are lower case.
+
+The index is split into JSON files ('shards') by the first --prefix-length
+characters of a term, hence a client-side search only needs to load the
+shards of the terms it looks for -- including all terms that start with a
+given prefix, if that prefix is at least as long as the shard key. Each
+shard ``terms-<key>.json`` has the form::
+
+  {"<term>": {"<binary package>": <fields>, ...}, ...}
+
+where ``<fields>`` is a bit mask of the fields the term occurs in. The file
+``index.json`` lists the bits of all fields, the shard key length, and a
+fingerprint of each shard (e.g. to be appended to the URL of a shard, to
+bypass stale cached copies).
+
+Only shards with terms of packages that changed since the last run are
+rebuilt and written. The state of the last run is kept in the destination
+directory. Use --force to rebuild all shards regardless.
+"""
+
+__docformat__ = 'restructuredtext'
+
+# magic line for manpage summary
+# man: -*- % generate a search index of all binary packages
+
+import argparse
+import os
+import re
+import json
+import logging
+
+from os.path import join as opj
+
+import bigmess
+from .helpers import parser_add_common_args, ensure_dir
+from ..utils import load_db, save_db, write_if_changed, get_fingerprint, \
+        load_fingerprints, metrics
+from ..profiling import phase
+from ..dbindex import parse_maintainers
+
+lgr = logging.getLogger(__name__)
+parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
+
+# name of the file in the destination directory that records the terms of all
+# indexed packages and the fingerprints of all shards
+STATE_FILENAME = '.bigmess_search_state.gz'
+# bump whenever the terms extracted from a package record change
+INDEX_FORMAT = 1
+# bit masks of the indexed fields
+FIELDS = dict(name=1, short_description=2, long_description=4, tags=8,
+              maintainer=16)
+# frequent words that are not worth indexing
+STOPWORDS = frozenset((
+    'a', 'about', 'all', 'also', 'an', 'and', 'any', 'are', 'as', 'at', 'be',
+    'been', 'but', 'by', 'can', 'do', 'does', 'for', 'from', 'has', 'have',
+    'how', 'if', 'in', 'into', 'is', 'it', 'its', 'may', 'more', 'most',
+    'no', 'not', 'of', 'on', 'one', 'only', 'or', 'other', 'over', 'so',
+    'some', 'such', 'than', 'that', 'the', 'their', 'them', 'then', 'there',
+    'these', 'they', 'this', 'those', 'through', 'to', 'under', 'up', 'very',
+    'via', 'was', 'well', 'were', 'what', 'when', 'where', 'which', 'while',
+    'who', 'will', 'with', 'within', 'without', 'you', 'your'))
+
+_re_word = re.compile(r'[a-z0-9]+')
+_re_shard_key = re.compile(r'[^a-z0-9]')
+
+
+def setup_parser(parser):
+    parser_add_common_args(parser, opt=('pkgdb',))
+    parser.add_argument('-d', '--dest-dir', default=os.curdir,
+                        help="""target directory for storing the index
+                        files""")
+    parser.add_argument('--prefix-length', type=int, metavar='N',
+                        help="""split the index into shards by the first N
+                        characters of each term. Default: as in the last run,
+                        or 1""")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="""rebuild all shards, even if none of their
+                        packages changed since the last run""")
+
+
+def _add_words(terms, text, field):
+    for word in _re_word.findall(text.lower()):
+        if len(word) < 2 or word in STOPWORDS:
+            continue
+        terms[word] = terms.get(word, 0) | field
+
+
+def get_search_record(pname, db):
+    """Return the parts of the DB records that are indexed for a package"""
+    binpkginfo = db['bin'][pname]
+    srcpkginfo = db['src'][binpkginfo['src_name']]
+    return dict(
+        name=pname,
+        short_description=binpkginfo.get('short_description', ''),
+        long_description=binpkginfo.get('long_description', []),
+        tags=srcpkginfo.get('upstream', {}).get('Tags', []),
+        maintainers=parse_maintainers(srcpkginfo, binpkginfo['src_name']))
+
+
+def get_package_terms(record):
+    """Extract the search terms of a package.
+
+    Parameters
+    ----------
+    record : dict
+      Output of get_search_record()
+
+    Returns
+    -------
+    dict
+      Bit mask of the fields (see ``FIELDS``) each term occurs in.
+    """
+    terms = {}
+    name = record['name'].lower()
+    # the full name, as well as its components (e.g. 'python3', 'nibabel')
+    terms[name] = FIELDS['name']
+    _add_words(terms, name, FIELDS['name'])
+    _add_words(terms, record['short_description'],
+               FIELDS['short_description'])
+    # paragraph separators ('.') carry no words
+    _add_words(terms, ' '.join(record['long_description']),
+               FIELDS['long_description'])
+    for tag in record['tags']:
+        tag = tag.lower()
+        terms[tag] = terms.get(tag, 0) | FIELDS['tags']
+        _add_words(terms, tag, FIELDS['tags'])
+    for mname, memail in record['maintainers']:
+        terms[memail] = terms.get(memail, 0) | FIELDS['maintainer']
+        _add_words(terms, mname, FIELDS['maintainer'])
+    return terms
+
+
+def get_shard_key(term, prefix_length):
+    """Return the key of the shard a term is stored in"""
+    return _re_shard_key.sub('_', term[:prefix_length])
+
+
+def _get_shard_filename(key):
+    return 'terms-%s.json' % key
+
+
+def _dump_json(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+def render_search_index(db, dest_dir, prefix_length=None, force=False):
+    """Build the search index and write all shards that changed.
+
+    Parameters
+    ----------
+    db : dict
+      Package DB
+    dest_dir : str
+      Directory to write the index into. It also holds the state of the last
+      run.
+    prefix_length : int or None
+      Length of the term prefix that determines the shard of a term. By
+      default, the length used in the last run (or 1 for a new index).
+    force : bool
+      If True, rebuild all shards, regardless of what changed.
+
+    Returns
+    -------
+    dict
+      Numbers of shards ``written``, ``unchanged`` (rebuilt, but identical
+      to the existing file), ``skipped`` (no package changed), and
+      ``removed`` (no terms left).
+    """
+    state_path = opj(dest_dir, STATE_FILENAME)
+    last_state = load_fingerprints(state_path)
+    if prefix_length is None:
+        # keep the layout of the existing index
+        prefix_length = last_state.get('prefix_length', 1)
+    if prefix_length < 1:
+        raise ValueError("prefix length must be positive, got %i"
+                         % prefix_length)
+    context_fprint = get_fingerprint(bigmess.__version__, INDEX_FORMAT,
+                                     FIELDS, prefix_length)
+    # shards of the last run -- need to be removed if they are gone now
+    last_shards = last_state.get('shards', {})
+    rebuild_all = force or last_state.get('context') != context_fprint
+    if rebuild_all:
+        last_pkgs = {}
+    else:
+        last_pkgs = last_state['packages']
+
+    # (fingerprint, terms) of all packages
+    pkgs = {}
+    # shards with terms of any new, changed, or removed package
+    dirty = set()
+    nindexed = 0
+    with phase('parse'):
+        for pname in db['bin']:
+            record = get_search_record(pname, db)
+            fprint = get_fingerprint(record)
+            last = last_pkgs.get(pname)
+            if not last is None and last[0] == fprint:
+                pkgs[pname] = last
+                continue
+            terms = get_package_terms(record)
+            pkgs[pname] = (fprint, terms)
+            nindexed += 1
+            for t in terms:
+                dirty.add(get_shard_key(t, prefix_length))
+            if not last is None:
+                # terms the package no longer has
+                for t in last[1]:
+                    dirty.add(get_shard_key(t, prefix_length))
+        for pname, (fprint, terms) in last_pkgs.items():
+            if not pname in pkgs:
+                for t in terms:
+                    dirty.add(get_shard_key(t, prefix_length))
+    metrics.inc('search_packages_indexed', nindexed)
+    lgr.debug("extracted terms of %i of %i binary packages"
+              % (nindexed, len(pkgs)))
+
+    # shards that can be kept as they are
+    if rebuild_all:
+        keep = set()
+    else:
+        keep = set([key for key in last_shards
+                    if not key in dirty
+                    and os.path.exists(opj(dest_dir,
+                                           _get_shard_filename(key)))])
+    with phase('render'):
+        shards = {}
+        all_keys = set()
+        for pname, (fprint, terms) in pkgs.items():
+            for t, fields in terms.items():
+                key = get_shard_key(t, prefix_length)
+                all_keys.add(key)
+                if key in keep:
+                    continue
+                shards.setdefault(key, {}).setdefault(t, {})[pname] = fields
+
+    counts = dict(written=0, unchanged=0, skipped=0, removed=0)
+    shard_fprints = {}
+    with phase('write'):
+        for key in sorted(all_keys):
+            if key in keep:
+                shard_fprints[key] = last_shards[key]
+                counts['skipped'] += 1
+                continue
+            content = _dump_json(shards[key])
+            shard_fprints[key] = get_fingerprint(content)
+            if write_if_changed(content,
+                                opj(dest_dir, _get_shard_filename(key))):
+                counts['written'] += 1
+            else:
+                counts['unchanged'] += 1
+        for key in set(last_shards).difference(all_keys):
+            fname = opj(dest_dir, _get_shard_filename(key))
+            if os.path.exists(fname):
+                lgr.debug("remove empty shard '%s'" % fname)
+                os.remove(fname)
+                counts['removed'] += 1
+        write_if_changed(_dump_json(dict(fields=FIELDS,
+                                         prefix_length=prefix_length,
+                                         shards=shard_fprints)),
+                         opj(dest_dir, 'index.json'))
+        save_db(dict(context=context_fprint, prefix_length=prefix_length,
+                     packages=pkgs, shards=shard_fprints),
+                state_path)
+    for c in counts:
+        metrics.inc('search_shards_%s' % c, counts[c])
+    lgr.info("search index: %(written)i shards written, %(unchanged)i "
+             "unchanged, %(skipped)i skipped (packages unchanged), "
+             "%(removed)i removed" % counts)
+    return counts
+
+
+def run(args):
+    lgr.debug("using package DB at '%s'" % args.pkgdb)
+    with phase('parse'):
+        db = load_db(args.pkgdb)
+    ensure_dir(args.dest_dir)
+    render_search_index(db, args.dest_dir, args.prefix_length, args.force)
@@ -0,0 +1,160 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Refresh the package portal in a single process.
+
+Runs the steps of the cachefiles, updatedb, mkpkgs, and mkpkgtocs commands in
+a row. The package DB is built in memory and handed directly to the page
+generators, and is only stored (if it changed) once all pages are generated.
+
+The new DB is compared with the previous one. If the existing package pages
+were rendered from the previous DB, pages of binary packages whose records
+did not change are skipped without recomputing their fingerprints (unless the
+templates or the configuration changed). As the DB is only stored at the very
+end, an interrupted refresh leaves the previous DB in place, and the next run
+considers all changes since then.
+
+The TOC of TOCs is written to ``pkg_tocs.rst`` in the TOC directory. With
+--search-dir the search index of the mksearchindex command is updated too,
+keeping the shard layout of an existing index.
+"""
+
+__docformat__ = 'restructuredtext'
+
+# magic line for manpage summary
+# man: -*- % refresh the package DB and all package pages
+
+import argparse
+import os
+import logging
+
+from os.path import join as opj
+
+from .helpers import parser_add_common_args, ensure_dir
+from .cmd_cachefiles import cache_files
+from .cmd_updatedb import update_db
+from .cmd_mkpkgs import render_pkg_pages, get_rendered_db_fingerprint
+from .cmd_mkpkgtocs import render_toc_pages
+from .cmd_mksearchindex import render_search_index
+from ..utils import load_db, save_db, write_if_changed, get_fingerprint, \
+        metrics
+from ..profiling import phase
+
+lgr = logging.getLogger(__name__)
+parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
+
+
+def setup_parser(parser):
+    parser_add_common_args(parser, opt=('filecache', 'pkgdb', 'jobs'))
+    parser.add_argument('--pkgs-dir', default=os.curdir,
+                        help="""target directory for storing the package
+                        pages. Default: current directory""")
+    parser.add_argument('--tocs-dir', default=os.curdir,
+                        help="""target directory for storing the table of
+                        contents pages. Default: current directory""")
+    parser.add_argument('--init-db',
+                        help="""inital DB""")
+    parser.add_argument('--skip-download', action='store_true',
+                        help="""do not update the file cache, only use the
+                        files already present""")
+    parser.add_argument('--force-update', action='store_true',
+                        help="""force updating files already present in the
+                        cache""")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="""render all pages, even if their inputs did not
+                        change since the last run""")
+    parser.add_argument('--page-size', type=int, default=0, metavar='N',
+                        help="""split TOCs of more than N source packages into
+                        several pages. Default: no splitting""")
+    parser.add_argument('--split-by', choices=('count', 'initial'),
+                        default='count',
+                        help="""how to split large TOCs: into pages of at most
+                        N packages each, or by package name initials.
+                        Default: count""")
+    parser.add_argument('--search-dir',
+                        help="""target directory for storing the search index.
+                        Default: no search index""")
+
+
+def get_unchanged_binaries(old_db, db):
+    """Determine binary packages with the same records in two package DBs.
+
+    Returns
+    -------
+    set
+      Names of binary packages whose record, and the record of their source
+      package, are identical in both DBs.
+    """
+    old_bindb = old_db['bin']
+    old_srcdb = old_db['src']
+    srcdb = db['src']
+    # comparison results by source package
+    same_src = {}
+    unchanged = set()
+    for pname, pkg in db['bin'].items():
+        if old_bindb.get(pname) != pkg:
+            continue
+        src_name = pkg['src_name']
+        if not src_name in same_src:
+            same_src[src_name] = old_srcdb.get(src_name) == srcdb[src_name]
+        if same_src[src_name]:
+            unchanged.add(pname)
+    return unchanged
+
+
+def run(args):
+    if not args.skip_download:
+        cache_files(args.filecache, args.force_update)
+
+    # the previous DB -- what all existing pages are based on
+    old_db = None
+    if os.path.exists(args.pkgdb):
+        with phase('parse'):
+            old_db = load_db(args.pkgdb)
+    init_db = None
+    if not args.init_db is None:
+        with phase('parse'):
+            init_db = load_db(args.init_db)
+    db = update_db(args.filecache, init_db)
+
+    unchanged = None
+    db_changed = True
+    if not old_db is None:
+        with phase('merge'):
+            db_changed = old_db != db
+            # the previous DB may have been updated since the pages were
+            # rendered (e.g. by the updatedb command)
+            if get_rendered_db_fingerprint(args.pkgs_dir) \
+                    == get_fingerprint(old_db):
+                unchanged = get_unchanged_binaries(old_db, db)
+        # no longer needed, and not worth inheriting by forked workers
+        del old_db
+    if unchanged is None:
+        lgr.info("package pages are not based on the previous DB, checking "
+                 "all %i binary packages" % len(db['bin']))
+    else:
+        nchanged = len(db['bin']) - len(unchanged)
+        metrics.set_gauge('changed_binary_packages', nchanged)
+        lgr.info("%i of %i binary packages changed since the last refresh"
+                 % (nchanged, len(db['bin'])))
+
+    for dest_dir in (args.pkgs_dir, args.tocs_dir, args.search_dir):
+        ensure_dir(dest_dir)
+    render_pkg_pages(db, args.pkgs_dir, jobs=args.jobs, force=args.force,
+                     unchanged=unchanged)
+    toctoc = render_toc_pages(db, args.tocs_dir, args.jobs, force=args.force,
+                              page_size=args.page_size,
+                              split_by=args.split_by)
+    if not args.search_dir is None:
+        render_search_index(db, args.search_dir, force=args.force)
+    with phase('write'):
+        write_if_changed(toctoc, opj(args.tocs_dir, 'pkg_tocs.rst'))
+        if db_changed:
+            save_db(db, args.pkgdb)
+        else:
+            lgr.debug("package DB did not change")
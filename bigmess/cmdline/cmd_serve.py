@@ -0,0 +1,224 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Answer queries on the package DB via HTTP.
+
+The DB is loaded once and indexed by release, task, and maintainer. Queries
+are answered with JSON documents:
+
+  /                      number of packages, all releases and tasks
+  /bin/<name>            record of a binary package (incl. its releases)
+  /src/<name>            record of a source package and its binary packages
+  /release/<codename>    source packages with binaries in a release
+  /task/<name>           source packages tagged with a task
+  /maintainer/<email>    source packages of a maintainer (or uploader)
+  /maintainers           names of all maintainers by email address
+
+Unknown items yield a 404 response with an 'error' member.
+
+By default the server listens on --address and --port. With --socket it
+listens on a local Unix socket instead, e.g. for::
+
+  curl --unix-socket /run/bigmess.sock http://localhost/bin/python3-nibabel
+
+The DB file is checked for changes every --check-interval seconds. A changed
+DB is loaded and indexed in the background, and replaces the previous one at
+once when ready -- queries are never answered from a partially loaded DB. If
+the new DB cannot be loaded, the previous one stays in service.
+"""
+
+__docformat__ = 'restructuredtext'
+
+# magic line for manpage summary
+# man: -*- % answer queries on the package DB via HTTP
+
+import argparse
+import os
+import json
+import stat
+import time
+import socket
+import logging
+import threading
+import socketserver
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .helpers import parser_add_common_args
+from ..utils import load_db
+from ..dbindex import PackageIndex
+
+lgr = logging.getLogger(__name__)
+parser_args = dict(formatter_class=argparse.RawDescriptionHelpFormatter)
+
+
+def setup_parser(parser):
+    parser_add_common_args(parser, opt=('pkgdb',))
+    parser.add_argument('--address', default='127.0.0.1',
+                        help="""address to listen on. Default: 127.0.0.1""")
+    parser.add_argument('--port', type=int, default=8780,
+                        help="""port to listen on. Default: 8780""")
+    parser.add_argument('--socket', metavar='PATH',
+                        help="""listen on a Unix socket at this location
+                        instead of a TCP port""")
+    parser.add_argument('--check-interval', type=float, default=5.0,
+                        metavar='SECONDS',
+                        help="""how often to check the DB file for changes.
+                        Default: 5""")
+
+
+def _get_file_state(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+class DBHolder(object):
+    """Holds the package index currently in service.
+
+    Requests take the ``current`` index once and use it throughout, hence
+    replacing it never affects a request in progress.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.current = None
+        self.loaded = None
+        # file states of the DB in service, and of the last one that failed
+        self._state = None
+        self._failed_state = None
+
+    def reload_if_changed(self):
+        """Load the DB file, if it changed since it was last loaded.
+
+        Returns
+        -------
+        bool
+          Whether a new DB was put into service.
+        """
+        state = _get_file_state(self.filename)
+        if state is None or state in (self._state, self._failed_state):
+            return False
+        lgr.debug("loading package DB from '%s'" % self.filename)
+        try:
+            index = PackageIndex(load_db(self.filename))
+        except Exception as e:
+            # the DB is eval'ed, anything can go wrong with a broken file
+            lgr.warning("cannot load package DB from '%s', keeping the "
+                        "previous one (%s)" % (self.filename, e))
+            self._failed_state = state
+            return False
+        self.current = index
+        self.loaded = time.time()
+        self._state = state
+        lgr.info("serving package DB from '%s' (%i binary packages)"
+                 % (self.filename, len(index.db['bin'])))
+        return True
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answer GET requests on the DB of ``server.holder``"""
+    server_version = 'bigmess'
+
+    def do_GET(self):
+        holder = self.server.holder
+        index = holder.current
+        path = urllib.parse.urlparse(self.path).path
+        parts = [urllib.parse.unquote(p) for p in path.strip('/').split('/')]
+        if parts == ['']:
+            res = index.get_summary()
+            res.update(db=holder.filename, loaded=holder.loaded)
+        elif parts == ['maintainers']:
+            res = index.get_maintainers()
+        elif len(parts) != 2:
+            self._reply(404, dict(error="unknown query '%s'" % path))
+            return
+        elif parts[0] == 'bin':
+            res = index.get_binary(parts[1])
+        elif parts[0] == 'src':
+            res = index.get_source(parts[1])
+        elif parts[0] in ('release', 'task', 'maintainer'):
+            res = index.get_sources(parts[0], parts[1])
+        else:
+            self._reply(404, dict(error="unknown query '%s'" % path))
+            return
+        if res is None:
+            self._reply(404, dict(error="unknown %s '%s'"
+                                        % (parts[0], parts[1])))
+        else:
+            self._reply(200, res)
+
+    def _reply(self, code, data):
+        body = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # there is no client address for Unix sockets
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        lgr.debug("%s %s" % (self.address_string(), format % args))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket, handling each request in a thread"""
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address) \
+                and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+            # left behind by a previous server
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        # attributes the request handler relies on
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def _watch_db(holder, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            holder.reload_if_changed()
+        except Exception as e:
+            # never let the watcher die
+            lgr.error("checking the package DB failed (%s)" % e)
+
+
+def run(args):
+    holder = DBHolder(args.pkgdb)
+    if not holder.reload_if_changed():
+        raise ValueError("cannot load package DB from '%s'" % args.pkgdb)
+    if args.socket is None:
+        server = ThreadingHTTPServer((args.address, args.port), QueryHandler)
+        lgr.info("listening on %s:%i" % (args.address, args.port))
+    else:
+        server = UnixHTTPServer(args.socket, QueryHandler)
+        lgr.info("listening on '%s'" % args.socket)
+    server.holder = holder
+    watcher = threading.Thread(target=_watch_db,
+                               args=(holder, args.check_interval))
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        lgr.info("shutting down")
+    finally:
+        server.server_close()
+        if not args.socket is None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -87,4 +87,20 @@ builder = (
          help="""select tool for carrying out the work""")
 )
 
+jobs = (
+    'jobs', ('-j', '--jobs'),
+    dict(type=int, default=1, metavar='N',
+         help="""number of worker processes to use. Work is split across
+         N processes that share the loaded package database. Default: 1,
+         i.e. no parallel processing""")
+)
 
+archive = (
+    'archive', ('--archive',),
+    dict(metavar='PATH',
+         help="""write all pages into a single tar archive at this location
+         instead of individual files into the destination directory. The
+         archive includes an index (index.json), and replaces any existing
+         archive atomically once complete. Compression is determined by the
+         file name extension (.tar, .tar.gz, .tar.bz2, .tar.xz)""")
+)
@@ -15,6 +15,10 @@ import re
 import sys
 import os
 import logging
+import xdg.BaseDirectory
+
+from collections import namedtuple
+from os.path import join as opj
 lgr = logging.getLogger(__name__)
 
 
@@ -175,3 +179,101 @@ def arg2bool(arg):
     else:
         raise argparse.ArgumentTypeError(
                 "'%s' cannot be converted into a boolean" % arg)
+
+
+BuildSettings = namedtuple('BuildSettings', (
+    'family', 'codename', 'builder', 'aptcache', 'build_basedir',
+    'result_dir', 'chroot_basedir', 'architectures', 'archall_architecture',
+    'debbuild_options', 'source_include', 'components', 'keyring',
+    'bootstrap_keyring', 'mirror', 'othermirror', 'backport_modify_control',
+    'backport_modify_control_blacklist', 'backport_maintainer',
+    'backport_version_suffix', 'condor_logdir'))
+
+
+def get_build_settings(family, codename, args=None):
+    """Resolve all build options for a build environment.
+
+    Each option is determined once, following the precedence of
+    get_build_option(): command line, family-specific configuration, generic
+    configuration, default.
+
+    Parameters
+    ----------
+    family : str
+      Build family ID
+    codename : str
+      Codename of the release/suite
+    args : argparse.Namespace or None
+      Parsed command line. Options not supported by a command are treated
+      as not given.
+
+    Returns
+    -------
+    BuildSettings
+      Immutable record. Paths are expanded, ``architectures``,
+      ``components`` and ``backport_modify_control_blacklist`` are lists
+      (``architectures`` is None if not configured), ``source_include`` is
+      the raw configuration value (to be converted with arg2bool()),
+      ``othermirror`` has the release codename substituted, and
+      ``backport_version_suffix`` is the configured backport ID of the
+      release (or None). Any other value is None if not configured.
+    """
+    from bigmess import cfg
+
+    def cli(name):
+        return getattr(args, name, None)
+
+    def as_list(value):
+        if value is None or isinstance(value, list):
+            return value
+        return value.split()
+
+    othermirror = get_build_option('othermirror', None, family)
+    if not othermirror is None:
+        othermirror = othermirror % {'release': codename}
+    return BuildSettings(
+        family=family,
+        codename=codename,
+        builder=get_build_option('builder', cli('builder'), family,
+                                 default='pbuilder'),
+        aptcache=get_path_cfg('aptcache', cli('aptcache'), family),
+        build_basedir=get_path_cfg('build basedir', cli('build_basedir'),
+                                   family),
+        result_dir=get_path_cfg('result directory', cli('result_dir'),
+                                family),
+        chroot_basedir=get_path_cfg(
+            'chroot basedir', cli('chroot_basedir'), family,
+            default=opj(xdg.BaseDirectory.xdg_data_home, 'bigmess',
+                        'chroots')),
+        architectures=as_list(get_build_option('architectures', cli('arch'),
+                                               family)),
+        archall_architecture=get_build_option('archall architecture',
+                                              cli('arch_all_arch'), family,
+                                              default='amd64'),
+        debbuild_options=get_build_option('debbuild options',
+                                          cli('debbuild_options'), family),
+        # only converted (see arg2bool()) if not overridden on the command line
+        source_include=get_build_option('source include', None, family),
+        components=as_list(get_build_option('components', cli('components'),
+                                            family, default='main')),
+        keyring=get_path_cfg('keyring', None, family),
+        bootstrap_keyring=get_path_cfg('bootstrap keyring', None, family),
+        mirror=get_build_option('mirror', None, family),
+        othermirror=othermirror,
+        backport_modify_control=get_build_option('backport modify control',
+                                                 cli('bp_mod_control'),
+                                                 family),
+        backport_modify_control_blacklist=as_list(get_build_option(
+            'backport modify control blacklist', family=family, default='')),
+        backport_maintainer=get_build_option('backport maintainer',
+                                             cli('bp_maintainer'), family),
+        backport_version_suffix=cfg.get('release backport ids', codename),
+        condor_logdir=get_path_cfg('condor logdir', cli('condor_logdir'),
+                                   family, default=os.curdir))
+
+
+def ensure_dir(path):
+    """Create a directory, unless it exists already (or ``path`` is None)"""
+    if not path is None and not os.path.exists(path):
+        lgr.debug("create directory '%s'" % path)
+        os.makedirs(path)
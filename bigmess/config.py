@@ -11,6 +11,8 @@
 __docformat__ = 'restructuredtext'
 
 import os.path
+import json
+import hashlib
 import xdg.BaseDirectory
 
 from os.path import join as opj
@@ -71,10 +73,21 @@ class ConfigManager(SafeConfigParser):
     the order stated above -- overwriting earlier configuration settings
     accordingly). Finally, the content of any `BIGMESS_*` environment variables
     overrides any settings read from any file.
+
+    The merged settings of all configuration files are cached in
+    'bigmess/config.json' in $XDG_CACHE_HOME (by default: ~/.cache/). As long
+    as no configuration file is added, removed, or modified, settings are
+    loaded from this snapshot instead of parsing all files again. Settings
+    from `BIGMESS_*` environment variables are never stored, but applied
+    anew each time.
     """
 
     # things we want to count on to be available
     _DEFAULTS = {'general': {'verbose': '1'}}
+    # number of configuration snapshots to keep in the cache
+    _MAX_SNAPSHOTS = 8
+    # format of the snapshot cache file -- other formats are ignored
+    _SNAPSHOT_FORMAT = 2
 
     def __init__(self, filenames=None):
         """Initialization reads settings from config files and env. variables.
@@ -92,6 +105,10 @@ class ConfigManager(SafeConfigParser):
                 self.set(sec, key, value)
 
         self.__cfg_filenames = []
+        # settings as of the last reload, without those from the environment
+        self.__file_state = self._get_state()
+        # (section, option) of all settings taken from the environment
+        self.__env_options = []
 
         # now get the setting
         self.reload(filenames)
@@ -124,11 +141,19 @@ class ConfigManager(SafeConfigParser):
         # runtime config
         cfg_file_candidates += self.__cfg_filenames
 
-        # read local and user-specific config
-        self.read(cfg_file_candidates)
+        self._unapply_env()
+        snapshot_key = self._get_snapshot_key(cfg_file_candidates)
+        if not self._load_snapshot(snapshot_key):
+            # read local and user-specific config
+            self.read(cfg_file_candidates)
+            self.__file_state = self._get_state()
+            self._save_snapshot(snapshot_key)
+
+        self._apply_env()
 
+    def _apply_env(self):
         # no look for variables in the environment
-        for var in [v for v in list(os.environ.keys()) if v.startswith('BIGMESS_')]:
+        for var in sorted([v for v in os.environ if v.startswith('BIGMESS_')]):
             # strip leading 'BIGMESS_' and lower case entries
             svar = var[10:].lower()
 
@@ -146,6 +171,102 @@ class ConfigManager(SafeConfigParser):
 
             # set value
             self.set(sec, svar, os.environ[var])
+            self.__env_options.append((sec, self.optionxform(svar)))
+
+    def _unapply_env(self):
+        # restore what the environment overrode in the last reload, to never
+        # store its settings in a snapshot
+        for sec, option in self.__env_options:
+            value = self.__file_state.get(sec, {}).get(option)
+            if value is None:
+                self.remove_option(sec, option)
+                if not sec in self.__file_state and not self.options(sec):
+                    self.remove_section(sec)
+            else:
+                self._sections[sec][option] = value
+        self.__env_options = []
+
+    def _get_state(self):
+        # all raw settings, including those in the DEFAULT section
+        state = dict([(sec, dict(self._sections[sec]))
+                      for sec in self._sections])
+        state[self.default_section] = dict(self._defaults)
+        return state
+
+    def _set_state(self, state):
+        # counterpart of _get_state() -- values are raw, hence they are
+        # stored without (interpolation) syntax checks, just like read() does
+        for sec, options in state.items():
+            if sec == self.default_section:
+                self._defaults.update(options)
+                continue
+            if not self.has_section(sec):
+                self.add_section(sec)
+            self._sections[sec].update(options)
+
+    def _get_snapshot_key(self, filenames):
+        # the outcome of reading the config files depends on the state before
+        # (apart from the environment, which is applied afterwards anyway),
+        # and the content of all files
+        files = []
+        for fname in filenames:
+            path = os.path.abspath(fname)
+            try:
+                st = os.stat(path)
+                files.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                files.append((path, None, None))
+        return hashlib.md5(json.dumps([self.__file_state, files],
+                                      sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _get_snapshot_filename():
+        cacheroot = xdg.BaseDirectory.xdg_cache_home
+        if not os.path.isabs(cacheroot):
+            cacheroot = os.path.expanduser(opj('~', '.cache'))
+        return opj(cacheroot, 'bigmess', 'config.json')
+
+    def _read_snapshots(self):
+        try:
+            with open(self._get_snapshot_filename()) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache, dict) \
+                or cache.get('format') != self._SNAPSHOT_FORMAT:
+            return {}
+        return cache['snapshots']
+
+    def _load_snapshot(self, key):
+        settings = self._read_snapshots().get(key)
+        if settings is None:
+            return False
+        self._set_state(settings)
+        self.__file_state = settings
+        return True
+
+    def _save_snapshot(self, key):
+        # keep a few snapshots, as bigmess reloads the configuration more
+        # than once on startup
+        snapshots = self._read_snapshots()
+        snapshots = dict([(k, snapshots[k])
+                          for k in list(snapshots)[-(self._MAX_SNAPSHOTS - 1):]
+                          if k != key])
+        snapshots[key] = self.__file_state
+        filename = self._get_snapshot_filename()
+        tmpname = '%s.tmp%i' % (filename, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            # settings may include credentials -- only for the user's eyes
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(format=self._SNAPSHOT_FORMAT,
+                               snapshots=snapshots), f)
+            os.rename(tmpname, filename)
+        except OSError:
+            # caching is optional
+            pass
 
     def get(self, section, option, default=None, **kwargs):
         """Wrapper around SafeConfigParser.get() with a custom default value.
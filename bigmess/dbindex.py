@@ -0,0 +1,218 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Inverted indices over the package DB for grouped views and queries"""
+
+__docformat__ = 'restructuredtext'
+
+import re
+import logging
+
+lgr = logging.getLogger(__name__)
+
+_re_maintainer = re.compile(r'(.*) <(.*)>')
+
+
+def parse_maintainers(srcinfo, src_name=None):
+    """Parse the maintainer and uploader fields of a source package record.
+
+    Parameters
+    ----------
+    srcinfo : dict
+      Source package record from the package DB
+    src_name : str or None
+      Name of the source package (only used for error reporting)
+
+    Returns
+    -------
+    list
+      ``(name, email)`` tuples, uploaders first, maintainer last. Email
+      addresses are normalized to lower case. For malformed entries the full
+      entry is used as name and email.
+    """
+    uploaders = [u.strip() for u in srcinfo.get('uploaders', '').split(',')]
+    maintainers = []
+    for maint in uploaders + [srcinfo.get('maintainer', '')]:
+        if not len(maint.strip()):
+            continue
+        match = _re_maintainer.match(maint)
+        if match is None:
+            lgr.warning('malformed maintainer listing for %s: %s'
+                        % (src_name, maint))
+            mname = memail = maint
+        else:
+            mname, memail = match.groups()
+        maintainers.append((mname, memail.lower()))
+    return maintainers
+
+
+def get_source_binaries(db):
+    """Map source package names to the records of their binary packages.
+
+    Only binary packages whose DB record points to a source package are
+    considered. Source packages without any such binary package are not
+    included.
+
+    Returns
+    -------
+    dict
+      Binary package records by name, for each source package. Source
+      packages are ordered by the last occurrence of any of their binary
+      packages in the DB.
+    """
+    src_bins = {}
+    for pname, pkg in db['bin'].items():
+        bins = src_bins.pop(pkg['src_name'], {})
+        bins[pname] = pkg
+        src_bins[pkg['src_name']] = bins
+    return src_bins
+
+
+def index_sources(db, keyfuncs, src_bins=None):
+    """Build inverted indices of source packages in a single pass over the DB.
+
+    Parameters
+    ----------
+    db : dict
+      Package DB
+    keyfuncs : dict
+      Callables by index name. Each is called as
+      ``keyfunc(src_name, srcinfo, binaries)`` with ``binaries`` being the
+      binary package records by name (see get_source_binaries()), and returns
+      an iterable of keys to file the source package under.
+    src_bins : dict or None
+      Output of get_source_binaries(), if already available.
+
+    Returns
+    -------
+    dict
+      For each index name a dict with a set of source package names for
+      each key.
+    """
+    if src_bins is None:
+        src_bins = get_source_binaries(db)
+    srcdb = db['src']
+    indices = dict([(name, {}) for name in keyfuncs])
+    for src_name, bins in src_bins.items():
+        srcinfo = srcdb[src_name]
+        for name, keyfunc in keyfuncs.items():
+            index = indices[name]
+            for key in keyfunc(src_name, srcinfo, bins):
+                if key in index:
+                    index[key].add(src_name)
+                else:
+                    index[key] = set((src_name,))
+    return indices
+
+
+def get_release_keys(src_name, srcinfo, binaries):
+    """Index key function: releases with any binary of a source package"""
+    releases = set()
+    for pkg in binaries.values():
+        releases.update(pkg['in_release'])
+    return releases
+
+
+def get_task_keys(src_name, srcinfo, binaries):
+    """Index key function: tasks a source package is tagged with"""
+    if 'upstream' in srcinfo and 'Tags' in srcinfo['upstream']:
+        return [tag[6:] for tag in srcinfo['upstream']['Tags']
+                if tag.startswith('task::')]
+    return []
+
+
+def build_index(db):
+    """Build the standard indices of source packages.
+
+    Returns
+    -------
+    dict
+      With the keys ``release``, ``task``, and ``maintainer`` (email
+      address) each holding a set of source package names by key. In
+      addition ``maintainer_name`` maps maintainer email addresses to names,
+      and ``src_binaries`` maps source package names to binary package
+      records (see get_source_binaries()).
+    """
+    maintainer_name = {}
+
+    def get_maintainer_keys(src_name, srcinfo, binaries):
+        emails = []
+        for mname, memail in parse_maintainers(srcinfo, src_name):
+            maintainer_name[memail] = mname
+            emails.append(memail)
+        return emails
+
+    src_bins = get_source_binaries(db)
+    index = index_sources(db,
+                          dict(release=get_release_keys,
+                               task=get_task_keys,
+                               maintainer=get_maintainer_keys),
+                          src_bins)
+    index['maintainer_name'] = maintainer_name
+    index['src_binaries'] = src_bins
+    return index
+
+
+class PackageIndex(object):
+    """Package DB with the standard indices, for answering queries.
+
+    All query methods return JSON-serializable data, or None if the queried
+    item is unknown.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.index = build_index(db)
+
+    def get_summary(self):
+        """Return the number of packages, and all releases and tasks"""
+        index = self.index
+        return dict(binary_packages=len(self.db['bin']),
+                    source_packages=len(self.db['src']),
+                    releases=sorted(index['release']),
+                    tasks=sorted(index['task']))
+
+    def get_binary(self, name):
+        """Return the record of a binary package"""
+        if not name in self.db['bin']:
+            return None
+        pkg = dict(self.db['bin'][name])
+        pkg['name'] = name
+        return pkg
+
+    def get_source(self, name):
+        """Return the record of a source package, and its binary packages"""
+        if not name in self.db['src']:
+            return None
+        src = dict(self.db['src'][name])
+        src['name'] = name
+        src['binaries'] = sorted(self.index['src_binaries'].get(name, {}))
+        return src
+
+    def get_sources(self, index_name, key):
+        """Return all source packages under a key of an index.
+
+        Parameters
+        ----------
+        index_name : {'release', 'task', 'maintainer'}
+        key : str
+          Release codename, task name, or maintainer email address (not
+          case-sensitive)
+        """
+        if index_name == 'maintainer':
+            key = key.lower()
+        sources = self.index[index_name].get(key)
+        if sources is None:
+            return None
+        res = {index_name: key, 'sources': sorted(sources)}
+        if index_name == 'maintainer':
+            res['name'] = self.index['maintainer_name'][key]
+        return res
+
+    def get_maintainers(self):
+        """Return the names of all maintainers by email address"""
+        return dict(self.index['maintainer_name'])
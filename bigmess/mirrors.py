@@ -0,0 +1,520 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Concurrent probing of repository mirrors"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import time
+import queue
+import socket
+import threading
+import logging
+import http.client
+import urllib.request
+import urllib.error
+import urllib.parse
+import email.utils
+
+from debian import deb822
+from bigmess import cfg
+
+lgr = logging.getLogger(__name__)
+
+# default time (in seconds) to wait for any response of a mirror
+DEFAULT_TIMEOUT = 10.0
+# default time (in seconds) for probing all mirrors
+DEFAULT_DEADLINE = 60.0
+
+
+def get_mirror_urls():
+    """Return the URLs of all configured mirrors by mirror code name"""
+    if not cfg.has_section('mirrors'):
+        return {}
+    return dict([(m, cfg.get('mirrors', m)) for m in cfg.options('mirrors')])
+
+
+def fetch_url(url, timeout=DEFAULT_TIMEOUT):
+    """Return the content at a URL.
+
+    ``timeout`` limits the time (in seconds) to wait for the connection and
+    for each subsequent response, not for the entire transfer.
+    """
+    u = urllib.request.urlopen(url, timeout=timeout)
+    try:
+        return u.read()
+    finally:
+        u.close()
+
+
+class ConnectionPool(object):
+    """Persistent HTTP(S) connections for repeated requests to mirrors.
+
+    Connections are kept open after a request and reused for the next
+    request to the same host. The pool can be shared by multiple threads.
+    """
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, scheme, netloc, timeout):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                conn = idle.pop()
+                if not conn.sock is None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def fetch(self, url, timeout=DEFAULT_TIMEOUT, max_redirects=3):
+        """Return the content at a URL (same as fetch_url())"""
+        parsed = urllib.parse.urlsplit(url)
+        if not parsed.scheme in ('http', 'https'):
+            raise urllib.error.URLError("unsupported URL '%s'" % url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = '%s?%s' % (path, parsed.query)
+        conn, reused = self._get_connection(parsed.scheme, parsed.netloc,
+                                            timeout)
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            content = resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if reused and not is_timeout(e):
+                # the server might have closed the idle connection -- try
+                # again with a new one
+                return self.fetch(url, timeout, max_redirects)
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.setdefault((parsed.scheme, parsed.netloc),
+                                      []).append(conn)
+        if resp.status in (301, 302, 303, 307, 308) \
+                and resp.getheader('Location') and max_redirects > 0:
+            return self.fetch(
+                urllib.parse.urljoin(url, resp.getheader('Location')),
+                timeout, max_redirects - 1)
+        if resp.status != 200:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                         resp.headers, None)
+        return content
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+
+def measure_download(url, timeout=DEFAULT_TIMEOUT, max_redirects=3):
+    """Download a file and measure how long it takes.
+
+    Redirects are followed, and the time of all requests is included in
+    the measurement.
+
+    Returns
+    -------
+    dict
+      ``connect`` (seconds until the connection was established),
+      ``ttfb`` (seconds until the first byte of the content arrived),
+      ``total`` (seconds for the entire download), ``size`` (in bytes),
+      and ``throughput`` (bytes per second after the first byte arrived,
+      or None if too fast to tell).
+    """
+    start = time.time()
+    connect = None
+    for i in range(max_redirects + 1):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme == 'https':
+            conn = http.client.HTTPSConnection(parsed.netloc, timeout=timeout)
+        elif parsed.scheme == 'http':
+            conn = http.client.HTTPConnection(parsed.netloc, timeout=timeout)
+        else:
+            raise urllib.error.URLError("unsupported URL '%s'" % url)
+        try:
+            conn.connect()
+            if connect is None:
+                connect = time.time() - start
+            path = parsed.path or '/'
+            if parsed.query:
+                path = '%s?%s' % (path, parsed.query)
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            if resp.status in (301, 302, 303, 307, 308) \
+                    and resp.getheader('Location'):
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status != 200:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                             resp.headers, None)
+            content = resp.read(1)
+            ttfb = time.time() - start
+            size = len(content)
+            while True:
+                content = resp.read(65536)
+                if not len(content):
+                    break
+                size += len(content)
+            total = time.time() - start
+        finally:
+            conn.close()
+        throughput = None
+        if total > ttfb and size > 1:
+            throughput = (size - 1) / (total - ttfb)
+        return dict(connect=connect, ttfb=ttfb, total=total, size=size,
+                    throughput=throughput)
+    raise urllib.error.URLError("too many redirects for '%s'" % url)
+
+
+def rank_by_speed(measurements):
+    """Return the code names of mirrors ordered by download time.
+
+    ``measurements`` are the results of probe_mirrors() with
+    measure_download() as probe. Mirrors without a successful measurement are
+    not included.
+    """
+    return sorted([m for m, res in measurements.items()
+                   if not res['result'] is None],
+                  key=lambda m: (measurements[m]['result']['total'], m))
+
+
+# options in the 'release files' section that are not releases: the data
+# archive, and a list of additional URLs
+NON_RELEASE_OPTIONS = ('data', 'urls')
+
+
+def get_releases():
+    """Return the code names of all configured releases (sorted)"""
+    return sorted([r for r in cfg.options('release files')
+                   if not r in NON_RELEASE_OPTIONS])
+
+
+def get_release_paths():
+    """Return the path of the Release file of each configured release.
+
+    Paths are relative to the base URL of a repository, e.g.
+    ``dists/squeeze/Release``.
+    """
+    paths = {}
+    for release in get_releases():
+        rurl = cfg.get('release files', release)
+        if '/dists/' in rurl:
+            paths[release] = rurl[rurl.index('/dists/') + 1:]
+        else:
+            paths[release] = 'dists/%s/Release' % release
+    return paths
+
+
+def parse_release(content):
+    """Return the date and index file checksums of a Release file.
+
+    Returns
+    -------
+    tuple
+      Time of the release (seconds since the epoch, or None if unknown), and
+      ``(size, checksum)`` by index file name, using the strongest checksum
+      listed.
+    """
+    rel = deb822.Release(content.decode('utf-8'))
+    date = None
+    if 'Date' in rel:
+        parsed = email.utils.parsedate_tz(rel['Date'])
+        if not parsed is None:
+            date = email.utils.mktime_tz(parsed)
+    checksums = {}
+    for field in ('SHA256', 'SHA1', 'MD5Sum'):
+        if not field in rel:
+            continue
+        key = field.lower()
+        for entry in rel[field]:
+            checksums[entry['name']] = (entry['size'], entry[key])
+        break
+    return date, checksums
+
+
+def compare_releases(primary, mirror):
+    """Compare a mirror's Release file with the one of the primary archive.
+
+    Parameters
+    ----------
+    primary, mirror : tuple
+      Output of parse_release()
+
+    Returns
+    -------
+    tuple
+      Outcome (one of the ``CONSISTENCY_*`` constants), and the names of
+      all index files that are missing on the mirror or differ.
+    """
+    pdate, psums = primary
+    mdate, msums = mirror
+    differ = sorted([name for name, sums in psums.items()
+                     if msums.get(name) != sums])
+    if not len(differ) and set(msums) == set(psums):
+        return CONSISTENCY_OK, differ
+    if not pdate is None and not mdate is None and mdate < pdate:
+        return CONSISTENCY_OUTDATED, differ
+    return CONSISTENCY_MISMATCH, differ
+
+
+def is_timeout(error):
+    """Whether an exception raised by a probe indicates a timeout"""
+    if isinstance(error, urllib.error.URLError):
+        error = error.reason
+    return isinstance(error, socket.timeout)
+
+
+def _run_probe(probe, url):
+    res = dict(result=None, error=None, unreachable=False)
+    start = time.time()
+    try:
+        res['result'] = probe(url)
+    except (OSError, http.client.HTTPException) as e:
+        # URLError and socket timeouts are OSErrors too
+        res['error'] = e
+        res['unreachable'] = is_timeout(e)
+    res['elapsed'] = time.time() - start
+    return res
+
+
+def probe_mirrors(urls, probe, jobs=None, deadline=DEFAULT_DEADLINE):
+    """Probe mirrors concurrently.
+
+    Parameters
+    ----------
+    urls : dict
+      URL to probe by mirror code name
+    probe : callable
+      Called with a URL, returns the probe result. Network errors
+      raised by it are caught and reported in the probe results.
+    jobs : int or None
+      Maximum number of simultaneous probes. If None, all mirrors are
+      probed at the same time.
+    deadline : float
+      Time (in seconds) for all probes to complete. Mirrors whose probe
+      did not complete by then are reported as unreachable.
+
+    Returns
+    -------
+    dict
+      Probe results by mirror code name. Each is a dict with the keys
+      ``result`` (return value of ``probe``, or None if it failed),
+      ``error`` (the exception that made the probe fail, or None),
+      ``unreachable`` (True if the mirror did not respond in time), and
+      ``elapsed`` (seconds the probe took, or None if it did not
+      complete).
+    """
+    if not len(urls):
+        return {}
+    if jobs is None:
+        jobs = len(urls)
+    pending = queue.Queue()
+    for item in urls.items():
+        pending.put(item)
+    # filled by the workers -- probes may complete after the deadline, hence
+    # results are taken from a snapshot
+    collected = {}
+    completed = threading.Condition()
+
+    def worker():
+        while True:
+            try:
+                mirror, url = pending.get_nowait()
+            except queue.Empty:
+                return
+            res = _run_probe(probe, url)
+            with completed:
+                collected[mirror] = res
+                completed.notify()
+
+    # daemon threads, as a hanging probe must not keep the process alive
+    # beyond the deadline
+    for i in range(max(1, min(jobs, len(urls)))):
+        threading.Thread(target=worker, daemon=True).start()
+    end = time.time() + deadline
+    with completed:
+        while len(collected) < len(urls) and time.time() < end:
+            completed.wait(end - time.time())
+        results = dict(collected)
+    # nothing left to start
+    while not pending.empty():
+        try:
+            pending.get_nowait()
+        except queue.Empty:
+            break
+    for mirror in urls:
+        if mirror in results:
+            continue
+        lgr.debug("no response from mirror %s within %.0f seconds"
+                  % (mirror, deadline))
+        results[mirror] = dict(result=None, error=None, unreachable=True,
+                               elapsed=None)
+    return results
+
+
+# outcomes of comparing a mirror's Release file with the primary archive
+CONSISTENCY_OK = 'consistent'         # same index files
+CONSISTENCY_OUTDATED = 'outdated'     # older Release file
+CONSISTENCY_MISMATCH = 'inconsistent'  # any other difference
+
+# outcomes of probing the stamp file of a mirror
+STATUS_OK = 'ok'                    # fresh
+STATUS_OLD = 'old'                  # stale
+STATUS_BROKEN = 'brk'               # stamp file content is not a timestamp
+STATUS_FAILED = 'na'                # request failed
+STATUS_UNREACHABLE = 'unreachable'  # no response in time
+# outcomes that prove a mirror was up
+REACHABLE_STATUSES = (STATUS_OK, STATUS_OLD, STATUS_BROKEN)
+
+
+class MirrorHistory(object):
+    """Append-only record of the outcomes of mirror probes.
+
+    Each probe is a line with tab-separated fields: time of the probe,
+    mirror code name, status (one of the ``STATUS_*`` constants), the
+    timestamp found on the mirror, and the duration of the probe in
+    milliseconds. Unknown values are recorded as ``-``.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, records):
+        """Record probe outcomes.
+
+        Parameters
+        ----------
+        records : list
+          ``(time, mirror, status, stamp, elapsed)`` tuples. ``stamp`` and
+          ``elapsed`` (in seconds) may be None.
+        """
+        hist_dir = os.path.dirname(self.filename)
+        if hist_dir and not os.path.exists(hist_dir):
+            os.makedirs(hist_dir)
+        lines = []
+        for t, mirror, status, stamp, elapsed in records:
+            lines.append('%i\t%s\t%s\t%s\t%s\n'
+                         % (t, mirror, status,
+                            '-' if stamp is None else '%i' % stamp,
+                            '-' if elapsed is None else '%i' % (elapsed * 1000)))
+        # a single write keeps the records of concurrent writers intact
+        with open(self.filename, 'a') as f:
+            f.write(''.join(lines))
+
+    def read(self, since=None):
+        """Yield recorded ``(time, mirror, status, stamp, elapsed)`` tuples
+
+        Only probes at or after ``since`` (if not None) are considered.
+        """
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    t, mirror, status, stamp, elapsed = \
+                            line.rstrip('\n').split('\t')
+                    t = int(t)
+                    stamp = None if stamp == '-' else int(stamp)
+                    elapsed = None if elapsed == '-' else int(elapsed) / 1000.
+                except ValueError:
+                    lgr.debug("ignoring malformed mirror history record %r"
+                              % line)
+                    continue
+                if not since is None and t < since:
+                    continue
+                yield t, mirror, status, stamp, elapsed
+
+    def get_latest(self, with_stamp=False):
+        """Return the most recent record for each mirror.
+
+        If ``with_stamp`` is True, only records with a known timestamp of
+        the mirror are considered.
+        """
+        latest = {}
+        for rec in self.read():
+            if with_stamp and rec[3] is None:
+                continue
+            if not rec[1] in latest or latest[rec[1]][0] <= rec[0]:
+                latest[rec[1]] = rec
+        return latest
+
+    def get_stats(self, since, now=None):
+        """Summarize the probes of each mirror since a point in time.
+
+        Returns
+        -------
+        dict
+          For each mirror a dict with the number of ``probes``, the
+          fraction of probes the mirror responded to (``uptime``), the
+          fraction of probes that found it fresh (``fresh``), and a
+          ``trend`` of freshness ('improving', 'worsening', 'stable', or None
+          if there is not enough data), comparing the first and the second
+          half of the period.
+        """
+        if now is None:
+            now = time.time()
+        middle = since + (now - since) / 2.
+        counts = {}
+        for t, mirror, status, stamp, elapsed in self.read(since):
+            # total, reachable, fresh -- for either half of the period
+            c = counts.setdefault(mirror, [[0, 0, 0], [0, 0, 0]])[t >= middle]
+            c[0] += 1
+            c[1] += status in REACHABLE_STATUSES
+            c[2] += status == STATUS_OK
+        stats = {}
+        for mirror, (early, late) in counts.items():
+            nprobes = early[0] + late[0]
+            trend = None
+            if early[0] and late[0]:
+                change = float(late[2]) / late[0] - float(early[2]) / early[0]
+                if change > 0.1:
+                    trend = 'improving'
+                elif change < -0.1:
+                    trend = 'worsening'
+                else:
+                    trend = 'stable'
+            stats[mirror] = dict(probes=nprobes,
+                                 uptime=float(early[1] + late[1]) / nprobes,
+                                 fresh=float(early[2] + late[2]) / nprobes,
+                                 trend=trend)
+        return stats
+
+    def prune(self, before):
+        """Drop all records of probes prior to a point in time
+
+        Records are in chronological order, hence the file is only rewritten
+        if its first record is outdated.
+        """
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            first = f.readline()
+        try:
+            if int(first.split('\t', 1)[0]) >= before:
+                return
+        except ValueError:
+            pass
+        tmpname = '%s.tmp%i' % (self.filename, os.getpid())
+        with open(self.filename) as src, open(tmpname, 'w') as dst:
+            for line in src:
+                try:
+                    if int(line.split('\t', 1)[0]) < before:
+                        continue
+                except ValueError:
+                    continue
+                dst.write(line)
+        os.rename(tmpname, self.filename)
@@ -0,0 +1,254 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Conversion of Debian package long descriptions into RST or HTML"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import re
+import html
+import hashlib
+import logging
+
+from .utils import load_db, save_db
+
+lgr = logging.getLogger(__name__)
+
+# increment whenever the conversion output changes -- invalidates all
+# previously cached conversion results
+CONVERTER_VERSION = 1
+
+_re_itemized = re.compile("^[-o*+] +")
+_re_itemized_gr = re.compile("^( *)([-o*+] +)?(.*?)$")
+
+
+def _unwrap_lines(lines):
+    out = []
+    indent_levels = [-1]
+    for l in lines:
+        match = _re_itemized_gr.search(l).groups()
+        if ((len(match[0]) in indent_levels and match[1] is None)
+            or (len(match[0]) > max(indent_levels) + 4)) \
+            and match[2].strip() != '.':
+            # append to previous
+            if not out[-1].endswith(" "):
+                out[-1] += " "
+            out[-1] += match[2]
+        else:
+            out.append(l)
+
+        indent_levels = [len(match[0])]
+        if match[1] is not None:
+            indent_levels += [len(match[0]) + len(match[1])]
+        if match[2].strip() == '.':
+            # reset though if '.'
+            indent_levels = [-1]
+    return out
+
+
+def _block_lines(ld):
+    # dedent all lines first
+    nleading = min([len(l) - len(l.lstrip(' ')) for l in ld])
+    ld = [l[nleading:] for l in ld]
+
+    # lets collect them in blocks/paragraphs
+    # next block can begin if
+    #  1.  . line
+    #  2. indentation changes
+    blocks, block = [], None
+    for l in ld:
+        if block is None or l.strip() == '.'\
+                or (len(l) and (len(block) and (
+                    (l.startswith(' ') and not block[-1].startswith(' '))
+                    or
+                    (not l.startswith(' ') and block[-1].startswith(' '))))):
+            block = []
+            blocks.append(block)
+        if l.strip() != '.':
+            block.append(l)
+    if len(blocks) == 1:
+        return blocks[0]
+    else:
+        return [_block_lines(b) for b in blocks if len(b)]
+
+
+def _blocks_to_rst(bls, level, out):
+    for b in bls:
+        if isinstance(b, list):
+            if len(b) == 1:
+                out.append(" " * level + b[0] + '\n\n')
+            else:
+                _blocks_to_rst(b, level + 1, out)
+        else:
+            e = " " * level + b + '\n'
+            if _re_itemized.search(b) and e[0] == ' ':
+                # strip 1 leading blank
+                e = e[1:]
+            out.append(e)
+    out.append('\n')
+
+
+def long_descr_to_rst(lines):
+    """Convert the lines of a package's long description into RST.
+
+    Parameters
+    ----------
+    lines : list
+      Lines of the long description (without the short description).
+
+    Returns
+    -------
+    str
+    """
+    lines = [l.replace('% ', '%% ').replace(r'\t', '    ') for l in lines]
+    out = []
+    _blocks_to_rst(_block_lines(_unwrap_lines(lines)), 0, out)
+    return ''.join(out)
+
+
+def _lines_to_html(lines, out):
+    # consecutive itemized lines form a list, everything else a paragraph
+    para, items = [], []
+    for l in lines:
+        match = _re_itemized.search(l)
+        if match:
+            if len(para):
+                out.append('<p>%s</p>\n' % ' '.join(para))
+                para = []
+            items.append(html.escape(l[match.end():].strip()))
+        elif len(items) and l.startswith(' '):
+            # continuation of an item
+            items[-1] += ' ' + html.escape(l.strip())
+        else:
+            if len(items):
+                out.append('<ul>\n%s</ul>\n'
+                           % ''.join(['<li>%s</li>\n' % i for i in items]))
+                items = []
+            para.append(html.escape(l.strip()))
+    if len(para):
+        out.append('<p>%s</p>\n' % ' '.join(para))
+    if len(items):
+        out.append('<ul>\n%s</ul>\n'
+                   % ''.join(['<li>%s</li>\n' % i for i in items]))
+
+
+def _blocks_to_html(bls, out):
+    if not len(bls) or not isinstance(bls[0], list):
+        # a single block of lines
+        _lines_to_html(bls, out)
+        return
+    for b in bls:
+        _blocks_to_html(b, out)
+
+
+def long_descr_to_html(lines):
+    """Convert the lines of a package's long description into HTML.
+
+    Paragraphs and itemized lists are detected in the same way as for
+    long_descr_to_rst(). All text is HTML-escaped.
+
+    Parameters
+    ----------
+    lines : list
+      Lines of the long description (without the short description).
+
+    Returns
+    -------
+    str
+    """
+    lines = [l.replace(r'\t', '    ') for l in lines]
+    out = []
+    _blocks_to_html(_block_lines(_unwrap_lines(lines)), out)
+    return ''.join(out)
+
+
+class DescriptionConverter(object):
+    """Long description converter with a persistent cache of results.
+
+    Results are cached by a hash of the description, hence a description
+    shared by many binary packages is only converted once -- and not at all
+    in subsequent runs, if a cache file is used. Use prune() to keep the
+    cache file from growing with every changed description.
+    """
+    def __init__(self, filename=None, convert=long_descr_to_rst):
+        """
+        Parameters
+        ----------
+        filename : str or None
+          Path of the cache file. If None, results are only cached in memory.
+        convert : callable
+          Function performing the actual conversion.
+        """
+        self._filename = filename
+        self._convert = convert
+        self._cache = {}
+        self._new = {}
+        self._pruned = False
+        if not filename is None and os.path.exists(filename):
+            try:
+                self._cache = load_db(filename)
+            except (IOError, EOFError, SyntaxError) as e:
+                lgr.warning("ignoring unreadable description cache at '%s' "
+                            "(%s)" % (filename, e))
+
+    @staticmethod
+    def _get_key(lines):
+        return hashlib.md5(
+            ('%i\n%s' % (CONVERTER_VERSION, '\n'.join(lines))).encode('utf-8')
+        ).hexdigest()
+
+    def __call__(self, lines):
+        key = self._get_key(lines)
+        if key in self._cache:
+            return self._cache[key]
+        res = self._convert(lines)
+        self._cache[key] = self._new[key] = res
+        return res
+
+    def pop_new(self):
+        """Return and forget all results added since the last call"""
+        new = self._new
+        self._new = {}
+        return new
+
+    def update(self, results):
+        """Add results, e.g. obtained from a converter in another process"""
+        self._cache.update(results)
+        self._new.update(results)
+
+    def prune(self, descriptions):
+        """Forget the results of all other descriptions.
+
+        Parameters
+        ----------
+        descriptions : iterable
+          Long descriptions (lists of lines) whose results are still needed,
+          e.g. those of all binary packages in the package DB. Results of
+          older converter versions are dropped too.
+        """
+        keep = set([self._get_key(lines) for lines in descriptions])
+        stale = [key for key in self._cache if not key in keep]
+        for key in stale:
+            del self._cache[key]
+            self._new.pop(key, None)
+        if len(stale):
+            lgr.debug("dropped %i outdated cached descriptions" % len(stale))
+            self._pruned = True
+
+    def save(self):
+        """Store the cache, if there is a cache file and anything changed"""
+        if self._filename is None \
+                or not (len(self._new) or self._pruned):
+            return
+        cache_dir = os.path.dirname(self._filename)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        save_db(self._cache, self._filename)
+        self._new = {}
+        self._pruned = False
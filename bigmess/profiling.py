@@ -0,0 +1,160 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Profiling of commands, and tracing of their processing phases.
+
+Commands mark their major steps with the phase() context manager, e.g.::
+
+  with phase('parse'):
+      db = load_db(filename)
+
+The wall time of each phase is recorded as a timer ``phase_<name>`` in the
+metrics of the command run (see bigmess.utils.Metrics). Further resource
+usage is only determined if phase tracing is enabled (``bigmess
+--trace-phases``). Common phase names are ``download``, ``parse``,
+``merge``, ``render``, and ``write``.
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+import sys
+import time
+import resource
+import importlib.util
+import logging
+
+from contextlib import contextmanager
+
+from .utils import metrics
+
+lgr = logging.getLogger(__name__)
+
+# accumulated (count, wall time, CPU time, peak RSS) by phase name -- None if
+# tracing is disabled
+_phases = None
+
+
+def _get_cpu_time():
+    # includes finished child processes, i.e. forked workers
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def _get_peak_rss():
+    # in kB (Linux)
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def enable_phase_tracing():
+    """Start recording wall time, CPU time, and peak RSS of all phases"""
+    global _phases
+    _phases = {}
+
+
+@contextmanager
+def phase(name):
+    """Context manager marking a processing phase of a command.
+
+    A phase may be entered any number of times, the resources used are
+    accumulated. CPU time includes that of worker processes that finished
+    within the phase. Peak RSS is that of the largest process so far.
+    """
+    tracing = not _phases is None
+    wall = time.time()
+    if tracing:
+        cpu = _get_cpu_time()
+    try:
+        yield
+    finally:
+        wall = time.time() - wall
+        metrics.observe('phase_%s' % name, wall)
+        if tracing:
+            cpu = _get_cpu_time() - cpu
+            rss = _get_peak_rss()
+            lgr.debug("phase '%s' took %.3f s (CPU: %.3f s)"
+                      % (name, wall, cpu))
+            count, twall, tcpu, trss = _phases.get(name, (0, 0.0, 0.0, 0))
+            _phases[name] = (count + 1, twall + wall, tcpu + cpu,
+                             max(trss, rss))
+
+
+def report_phases(stream=None):
+    """Print a summary of all traced phases (in order of first occurrence)"""
+    if not _phases:
+        return
+    if stream is None:
+        stream = sys.stderr
+    stream.write("%-12s %6s %10s %10s %13s\n"
+                 % ('phase', 'count', 'wall [s]', 'CPU [s]', 'peak RSS [MB]'))
+    for name, (count, wall, cpu, rss) in _phases.items():
+        stream.write("%-12s %6i %10.3f %10.3f %13.1f\n"
+                     % (name, count, wall, cpu, rss / 1024.))
+
+
+def _get_profiler(profiler):
+    if profiler != 'auto':
+        return profiler
+    if importlib.util.find_spec('pyinstrument') is None:
+        return 'cprofile'
+    return 'pyinstrument'
+
+
+def run_profiled(func, args, profiler='auto', output=None, ntop=25):
+    """Call ``func(args)`` under a profiler and report the hot spots.
+
+    Only the calling process is profiled, not any forked worker process.
+
+    Parameters
+    ----------
+    func : callable
+    args
+      Argument for ``func``
+    profiler : {'auto', 'cprofile', 'pyinstrument'}
+      'auto' uses the pyinstrument sampling profiler if it is installed, and
+      cProfile otherwise.
+    output : str or None
+      File to write the profile to: pstats format for cProfile, and HTML (if
+      the name ends with '.html') or text for pyinstrument.
+    ntop : int
+      Number of functions to list in the cProfile report.
+
+    Returns
+    -------
+    Return value of ``func``
+    """
+    profiler = _get_profiler(profiler)
+    lgr.debug("profiling with %s" % profiler)
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        prof = Profiler()
+        prof.start()
+        try:
+            return func(args)
+        finally:
+            prof.stop()
+            report = prof.output_text(color=False)
+            if not output is None:
+                with open(output, 'w') as f:
+                    if output.endswith('.html'):
+                        f.write(prof.output_html())
+                    else:
+                        f.write(report)
+            sys.stderr.write(report)
+    else:
+        import cProfile
+        import pstats
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(func, args)
+        finally:
+            if not output is None:
+                prof.dump_stats(output)
+            stats = pstats.Stats(prof, stream=sys.stderr)
+            stats.sort_stats('cumulative').print_stats(ntop)
@@ -0,0 +1,180 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the bigmess package for the
+#   copyright and license terms.
+#
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Sphinx extension that renders package pages straight from the package DB.
+
+Enable it in a project's ``conf.py``::
+
+  extensions = ['bigmess.sphinxext']
+  # package DB (default: ~/.cache/bigmess/pkgdb.gz)
+  bigmess_pkgdb = '/srv/portal/pkgdb.gz'
+  # directory (relative to the source directory) holding all documents
+  bigmess_docs_dir = 'pkgs'
+
+A document is registered for every binary package (same content as
+generated by ``bigmess mkpkgs``), every table of contents (as generated by
+``bigmess mkpkgtocs``), and the TOC of TOCs (``<bigmess_docs_dir>/pkg_tocs``).
+On disk each document is only a tiny stub that records a fingerprint of all
+its inputs -- its actual content is rendered from the DB when Sphinx reads the
+document. Stubs are only rewritten when their fingerprint changes, hence an
+incremental Sphinx build only re-reads documents of packages that changed.
+Stubs of packages no longer in the DB are removed.
+
+Rendering happens while Sphinx reads documents, and the DB is loaded before
+any reader process is forked. The extension therefore supports parallel
+reading (``sphinx-build -j N``).
+
+Further configuration values are ``bigmess_pkg_template``,
+``bigmess_toc_template``, and ``bigmess_toctoc_template`` to use custom
+templates instead of the shipped ones, and ``bigmess_toc_page_size`` and
+``bigmess_toc_split_by`` to split large TOCs into several documents (same as
+the --page-size and --split-by options of ``bigmess mkpkgtocs``).
+"""
+
+__docformat__ = 'restructuredtext'
+
+import os
+
+from os.path import join as opj
+from sphinx.util import logging
+
+import bigmess
+from .utils import load_db, get_cache_dir, get_template, get_template_hash, \
+        get_fingerprint, write_if_changed
+from .pkgdescr import DescriptionConverter
+from .cmdline.cmd_mkpkgs import gen_pkg_page, get_page_fingerprint, \
+        SourceContexts
+from .cmdline.cmd_mkpkgtocs import get_toc_specs, get_toctoc, \
+        get_toc_fingerprint, render_toc_page, get_sorted_binaries, \
+        paginate_toc_specs, get_toc_pages
+
+lgr = logging.getLogger(__name__)
+
+# first line of every stub document
+STUB_MARKER = '.. bigmess virtual document'
+
+# everything needed to render documents -- set up before Sphinx forks any
+# parallel reader process
+_state = {}
+
+
+def _get_docs_dir(app):
+    return opj(str(app.srcdir), app.config.bigmess_docs_dir)
+
+
+def _write_stubs(docs_dir, fprints):
+    if not os.path.exists(docs_dir):
+        os.makedirs(docs_dir)
+    nwritten = 0
+    for name, fprint in fprints.items():
+        if write_if_changed('%s: %s\n' % (STUB_MARKER, fprint),
+                            opj(docs_dir, '%s.rst' % name)):
+            nwritten += 1
+    # remove stubs of documents that are gone
+    for fname in os.listdir(docs_dir):
+        if not fname.endswith('.rst') or fname[:-4] in fprints:
+            continue
+        fpath = opj(docs_dir, fname)
+        with open(fpath) as f:
+            is_stub = f.readline().startswith(STUB_MARKER)
+        if is_stub:
+            os.remove(fpath)
+    return nwritten
+
+
+def _on_builder_inited(app):
+    conf = app.config
+    pkgdb = conf.bigmess_pkgdb
+    if pkgdb is None:
+        pkgdb = opj(get_cache_dir(), 'pkgdb.gz')
+    lgr.debug("using package DB at '%s'" % pkgdb)
+    db = load_db(pkgdb)
+    pkg_template = get_template('binary_pkg.rst', conf.bigmess_pkg_template)
+    toc_template = get_template('srcpkg_toc.rst', conf.bigmess_toc_template)
+    toctoc_template = get_template('pkg_tocs.rst',
+                                   conf.bigmess_toctoc_template)
+    docs = {}
+    fprints = {}
+    template_hash = get_template_hash(pkg_template)
+    for pname in db['bin']:
+        docs[pname] = ('pkg', pname)
+        fprints[pname] = get_page_fingerprint(pname, db, template_hash)
+    specs = paginate_toc_specs(get_toc_specs(db), conf.bigmess_toc_page_size,
+                               by_initial=conf.bigmess_toc_split_by == 'initial')
+    template_hash = get_template_hash(toc_template)
+    binaries = get_sorted_binaries(db)
+    for label, spec in specs.items():
+        docs[label] = ('toc', spec)
+        fprints[label] = get_toc_fingerprint(spec, db, template_hash,
+                                             binaries)
+    toctoc = dict(toctoc=get_toctoc(specs), toc_pages=get_toc_pages(specs))
+    docs['pkg_tocs'] = ('toctoc', toctoc)
+    fprints['pkg_tocs'] = get_fingerprint(
+        bigmess.__version__, get_template_hash(toctoc_template), toctoc)
+
+    nwritten = _write_stubs(_get_docs_dir(app), fprints)
+    lgr.info("%i of %i package documents need to be (re)read"
+             % (nwritten, len(fprints)))
+    docname_prefix = conf.bigmess_docs_dir.strip('/').replace(os.sep, '/')
+    _state.clear()
+    _state.update(
+        db=db,
+        binaries=binaries,
+        docs=dict([('%s/%s' % (docname_prefix, name), doc)
+                   for name, doc in docs.items()]),
+        templates=dict(pkg=pkg_template, toc=toc_template,
+                       toctoc=toctoc_template),
+        descr_converter=DescriptionConverter(
+            opj(get_cache_dir(), 'descr_rst_cache.gz')),
+        src_contexts=SourceContexts(db['src']))
+
+
+def _on_source_read(app, docname, source):
+    doc = _state.get('docs', {}).get(docname)
+    if doc is None:
+        # not one of ours
+        return
+    kind, item = doc
+    db = _state['db']
+    template = _state['templates'][kind]
+    if kind == 'pkg':
+        source[0] = gen_pkg_page(item, db, template,
+                                 _state['descr_converter'],
+                                 _state['src_contexts'])
+    elif kind == 'toc':
+        source[0] = render_toc_page(item, template, db,
+                                    _state['binaries'])
+    else:
+        source[0] = template.render(**item)
+
+
+def _on_build_finished(app, exception):
+    if exception is None and 'descr_converter' in _state:
+        descr_converter = _state['descr_converter']
+        descr_converter.prune([p['long_description']
+                               for p in _state['db']['bin'].values()
+                               if 'long_description' in p])
+        descr_converter.save()
+
+
+def setup(app):
+    # changes of the DB or templates are covered by the document fingerprints
+    # and must not trigger a full re-read
+    app.add_config_value('bigmess_pkgdb', None, '')
+    app.add_config_value('bigmess_docs_dir', 'pkgs', 'env')
+    app.add_config_value('bigmess_pkg_template', None, '')
+    app.add_config_value('bigmess_toc_template', None, '')
+    app.add_config_value('bigmess_toctoc_template', None, '')
+    app.add_config_value('bigmess_toc_page_size', 0, '')
+    app.add_config_value('bigmess_toc_split_by', 'count', '')
+    app.connect('builder-inited', _on_builder_inited)
+    app.connect('source-read', _on_source_read)
+    app.connect('build-finished', _on_build_finished)
+    return {'version': bigmess.__version__,
+            'parallel_read_safe': True,
+            'parallel_write_safe': True}
@@ -11,8 +11,12 @@
 __docformat__ = 'restructuredtext'
 
 import os
+import io
+import time
 import gzip
 import codecs
+import hashlib
+import json
 import xdg.BaseDirectory
 import logging
 
@@ -41,6 +45,69 @@ def get_cache_dir():
     return cachepath
 
 
+# Jinja environments (one per template location) shared by everything that
+# runs in this process
+_jinja_envs = {}
+
+
+def get_jinja_env(templ_dir=None):
+    """Return the Jinja environment for a template location.
+
+    Only a single environment per template location is created in each
+    process, and compiled templates are kept in a bytecode cache in the
+    bigmess cache directory, hence templates are not recompiled on every
+    invocation. HTML templates (.html) are rendered with auto-escaping.
+
+    Parameters
+    ----------
+    templ_dir : str or None
+      Directory with custom templates. If None, the templates shipped with
+      bigmess are used.
+    """
+    if not templ_dir is None:
+        templ_dir = os.path.abspath(templ_dir)
+    if templ_dir in _jinja_envs:
+        return _jinja_envs[templ_dir]
+    from jinja2 import Environment, PackageLoader, FileSystemLoader, \
+            ChoiceLoader, FileSystemBytecodeCache, select_autoescape
+    if templ_dir is None:
+        loader = PackageLoader('bigmess')
+    else:
+        # custom templates can still include/extend shipped ones
+        loader = ChoiceLoader([FileSystemLoader(templ_dir),
+                               PackageLoader('bigmess')])
+    bccache_dir = opj(get_cache_dir(), 'jinja')
+    try:
+        if not os.path.exists(bccache_dir):
+            os.makedirs(bccache_dir)
+        bccache = FileSystemBytecodeCache(bccache_dir)
+    except OSError as e:
+        lgr.debug("cannot use template bytecode cache at '%s' (%s)"
+                  % (bccache_dir, e))
+        bccache = None
+    env = Environment(loader=loader, bytecode_cache=bccache,
+                      autoescape=select_autoescape(['html'],
+                                                   default_for_string=False))
+    _jinja_envs[templ_dir] = env
+    return env
+
+
+def get_template(name, custom_path=None):
+    """Load a template shipped with bigmess, or a custom one.
+
+    Parameters
+    ----------
+    name : str
+      Name of a template shipped with bigmess.
+    custom_path : str or None
+      Path to a custom template file that is used instead, if not None.
+    """
+    if custom_path is None:
+        return get_jinja_env().get_template(name)
+    return get_jinja_env(os.path.dirname(custom_path)).get_template(
+        os.path.basename(custom_path))
+
+
 def load_db(filename):
     """Load the package DB from file"""
     gzf = gzip.open(filename, 'rb')
@@ -52,16 +119,375 @@ def load_db(filename):
 
 
 def save_db(db, filename):
-    """Store a package DB as compressed text file"""
+    """Store a package DB as compressed text file.
+
+    The file is replaced atomically, hence concurrent readers (e.g. ``bigmess
+    serve``) never see a partially written DB.
+    """
     pp = PrettyPrinter(indent=2)
-    gzf = gzip.open(filename, 'wb')
+    tmpname = '%s.%i.tmp' % (filename, os.getpid())
+    gzf = gzip.open(tmpname, 'wb')
     utf_writer = codecs.getwriter('utf-8')
     utf_contents = utf_writer(gzf)
     utf_contents.write(pp.pformat(db))
     gzf.close()
+    os.rename(tmpname, filename)
+
+
+def write_if_changed(content, filename):
+    """Write text to a file, unless the file already has identical content.
+
+    Leaving unchanged files alone preserves their modification time, hence
+    tools like Sphinx only need to process files that actually changed.
+
+    Parameters
+    ----------
+    content : str
+      Text to be written (UTF-8 encoded).
+    filename : str
+      Path of the output file.
+
+    Returns
+    -------
+    bool
+      True if the file was written, False if it was left untouched.
+    """
+    data = content.encode('utf-8')
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            if hashlib.md5(f.read()).digest() == hashlib.md5(data).digest():
+                return False
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return True
+
+
+def get_fingerprint(*args):
+    """Compute a fingerprint of arbitrary (JSON-serializable) input data.
+
+    Dictionaries are serialized with sorted keys, hence the fingerprint does
+    not depend on the insertion order of any mapping.
+
+    Returns
+    -------
+    str
+      Hex digest.
+    """
+    return hashlib.md5(
+        json.dumps(args, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+def get_template_hash(template):
+    """Return a hash of the source code of a Jinja template.
+
+    The sources of all templates it extends, includes, or imports are
+    considered too.
+    """
+    from jinja2 import meta
+    env = template.environment
+    md5 = hashlib.md5()
+    todo = [template.name]
+    seen = set()
+    while len(todo):
+        name = todo.pop(0)
+        if name in seen:
+            continue
+        seen.add(name)
+        source = env.loader.get_source(env, name)[0]
+        md5.update(source.encode('utf-8'))
+        todo.extend([t for t in meta.find_referenced_templates(env.parse(source))
+                     if not t is None])
+    return md5.hexdigest()
+
+
+def load_fingerprints(filename):
+    """Load a fingerprint store, or return an empty one if there is none"""
+    if not os.path.exists(filename):
+        return {}
+    try:
+        return load_db(filename)
+    except (IOError, EOFError, SyntaxError) as e:
+        lgr.warning("ignoring unreadable fingerprint store at '%s' (%s)"
+                    % (filename, e))
+        return {}
 
 
 def underline_text(text, symbol):
     """Underline a string with a given symbol"""
     underline = symbol * len(text)
     return '%s\n%s\n' % (text, underline)
+
+
+def split_into_chunks(items, nchunks):
+    """Split a sequence into at most ``nchunks`` contiguous chunks"""
+    items = list(items)
+    if not len(items):
+        return []
+    size = -(-len(items) // max(1, nchunks))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def imap_forked(func, chunks, jobs=1):
+    """Apply a function to a list of work chunks in forked worker processes.
+
+    Workers are forked from the calling process, hence any state prepared
+    before the call (e.g. a loaded package DB) is shared copy-on-write and
+    never needs to be pickled. Only the chunks and the return values travel
+    between processes. With ``jobs`` < 2 everything runs in the calling
+    process.
+
+    Returns
+    -------
+    generator
+      Return values of ``func`` in the order of ``chunks``, yielded as soon
+      as they become available.
+    """
+    if jobs < 2 or len(chunks) < 2:
+        for c in chunks:
+            yield func(c)
+        return
+    import multiprocessing
+    lgr.debug("distribute %i work chunks across %i processes"
+              % (len(chunks), jobs))
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        for res in pool.imap(func, chunks, chunksize=1):
+            yield res
+
+
+def map_forked(func, chunks, jobs=1):
+    """Like imap_forked(), but returns a list of all return values"""
+    return list(imap_forked(func, chunks, jobs))
+
+
+class DirPageWriter(object):
+    """Write pages as individual files into a directory.
+
+    Files are only written if their content changed (see write_if_changed()).
+    """
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_page(self, name, content):
+        """Write a page, returns True if the file was (re)written"""
+        return write_if_changed(content, opj(self.dest_dir, name))
+
+    def close(self):
+        pass
+
+
+class ArchivePageWriter(object):
+    """Stream pages into a single tar archive.
+
+    The archive is written to a temporary file next to its destination and is
+    only moved into place by close(). Hence deploying a set of pages is a
+    single sequential write followed by an atomic rename. As its last member
+    the archive contains an index (``index.json``) with size and MD5 sum of
+    every page. Compression is determined by the filename extension
+    (.tar, .tar.gz/.tgz, .tar.bz2, .tar.xz).
+
+    When used as a context manager, the archive is finalized on success, and
+    discarded if an exception occurred.
+    """
+    def __init__(self, filename):
+        import tarfile
+        compression = ''
+        for ext, comp in (('.gz', 'gz'), ('.tgz', 'gz'), ('.bz2', 'bz2'),
+                          ('.xz', 'xz')):
+            if filename.endswith(ext):
+                compression = comp
+        self.filename = filename
+        self._tmpname = '%s.tmp%i' % (filename, os.getpid())
+        self._tar = tarfile.open(self._tmpname, 'w|%s' % compression)
+        self._index = {}
+        self._mtime = int(time.time())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _add(self, name, data):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self._mtime
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def write_page(self, name, content):
+        """Add a page to the archive, always returns True"""
+        data = content.encode('utf-8')
+        self._add(name, data)
+        self._index[name] = dict(size=len(data),
+                                 md5=hashlib.md5(data).hexdigest())
+        return True
+
+    def close(self):
+        """Finalize the archive and move it into place"""
+        self._add('index.json',
+                  json.dumps(self._index, indent=1, sort_keys=True).encode())
+        self._tar.close()
+        os.rename(self._tmpname, self.filename)
+        lgr.debug("wrote %i pages into '%s'"
+                  % (len(self._index), self.filename))
+
+    def abort(self):
+        """Discard the archive, leaving any existing one untouched"""
+        self._tar.close()
+        os.remove(self._tmpname)
+
+
+def get_page_writer(dest_dir, archive=None):
+    """Return a writer for generated pages.
+
+    Parameters
+    ----------
+    dest_dir : str
+      Directory to write individual pages into.
+    archive : str or None
+      If not None, pages are written into a tar archive at this location
+      instead.
+    """
+    if archive is None:
+        return DirPageWriter(dest_dir)
+    return ArchivePageWriter(archive)
+
+
+class Metrics(object):
+    """Counters, gauges, and timers of a command run.
+
+    All commands record into the shared ``metrics`` instance of this module.
+    When the ``bigmess`` command finishes, the collected values are written
+    to a file (if requested), either as a line of JSON, or in the text format
+    of the Prometheus node exporter's textfile collector.
+
+    Values recorded in forked worker processes are lost -- record them in the
+    parent process, e.g. based on what workers return.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget all recorded values"""
+        self._counters = {}
+        self._gauges = {}
+        # (count, total seconds) by name
+        self._timers = {}
+
+    def inc(self, name, value=1):
+        """Increment a counter"""
+        self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        """Set a gauge to a value"""
+        self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Add the duration of an event to a timer"""
+        count, total = self._timers.get(name, (0, 0.0))
+        self._timers[name] = (count + 1, total + seconds)
+
+    def timer(self, name):
+        """Context manager timing the enclosed code with observe()"""
+        return _MetricsTimer(self, name)
+
+    def get_values(self):
+        """Return all recorded values.
+
+        Returns
+        -------
+        dict
+          With the keys ``counters`` and ``gauges`` (values by name), and
+          ``timers`` (dicts with ``count`` and ``seconds`` by name).
+        """
+        return dict(
+            counters=dict(self._counters),
+            gauges=dict(self._gauges),
+            timers=dict([(name, dict(count=count, seconds=total))
+                         for name, (count, total) in self._timers.items()]))
+
+    def write(self, filename, fmt='json', command=None):
+        """Write all recorded values to a file.
+
+        Parameters
+        ----------
+        filename : str
+          Destination. A literal ``%(command)s`` is replaced by the command
+          name, e.g. to give each command its own Prometheus file.
+        fmt : {'json', 'prometheus'}
+          'json' appends a single line with all values (and the time and
+          command) to the file. 'prometheus' replaces the file (atomically)
+          with all values in the Prometheus text exposition format. Metric
+          names get a ``bigmess_`` prefix, counters a ``_total`` suffix, and
+          timers are exported as summaries ``<name>_seconds``. All metrics
+          carry a ``command`` label.
+        command : str or None
+          Name of the command that recorded the values.
+        """
+        # no %-formatting, any other '%' is taken literally
+        filename = filename.replace('%(command)s', '%s' % command)
+        dest_dir = os.path.dirname(filename)
+        if dest_dir and not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if fmt == 'json':
+            record = self.get_values()
+            record.update(time=time.time(), command=command)
+            with open(filename, 'a') as f:
+                f.write('%s\n' % json.dumps(record, sort_keys=True))
+        elif fmt == 'prometheus':
+            # the textfile collector must never see a partially written file
+            tmpname = '%s.%i.tmp' % (filename, os.getpid())
+            with open(tmpname, 'w') as f:
+                f.write(self._format_prometheus(command))
+            os.rename(tmpname, filename)
+        else:
+            raise ValueError("unknown metrics format '%s'" % fmt)
+        lgr.debug("wrote metrics to '%s'" % filename)
+
+    def _format_prometheus(self, command):
+        labels = '{command="%s"}' % command if command else ''
+        lines = []
+
+        def add(name, kind, values):
+            name = 'bigmess_%s' % name
+            lines.append('# TYPE %s %s' % (name, kind))
+            for suffix, value in values:
+                lines.append('%s%s%s %r' % (name, suffix, labels, value))
+
+        for name in sorted(self._counters):
+            add('%s_total' % name, 'counter', [('', self._counters[name])])
+        for name in sorted(self._gauges):
+            add(name, 'gauge', [('', self._gauges[name])])
+        for name in sorted(self._timers):
+            count, total = self._timers[name]
+            add('%s_seconds' % name, 'summary',
+                [('_sum', total), ('_count', count)])
+        return ''.join(['%s\n' % l for l in lines])
+
+
+class _MetricsTimer(object):
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._metrics.observe(self._name, time.time() - self._start)
+
+
+# the metrics of this process
+metrics = Metrics()
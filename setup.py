@@ -48,7 +48,9 @@ def main(**extra_args):
           packages=['bigmess',
                     'bigmess.cmdline',
                     ],
-          package_data={'bigmess': ['bigmess.cfg']},
+          package_data={'bigmess': ['bigmess.cfg',
+                                    'templates/*.rst',
+                                    'templates/*.html']},
           scripts=glob(os.path.join('bin', '*'))
           )
 